@@ -1,11 +1,51 @@
 from flask import Flask
 from app.config import Config
+from app.engine import configure_sqlite, get_engine_options
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
-    
-app = Flask(__name__)
-app.config.from_object(Config)
-db = SQLAlchemy(app)
-migrate = Migrate(app, db)
 
-from app import routes, models
\ No newline at end of file
+db = SQLAlchemy()
+migrate = Migrate()
+
+##########
+#
+#   Build the application.  The routes, models and commands are only imported here,
+#   so importing the package stays cheap.  Unless WARMUP is turned off, the
+#   selection caches are loaded before the app is returned, so that a worker does
+#   not make its first participants wait for them.  The time taken by each phase is
+#   logged.
+#
+##########
+def create_app(config_class=Config):
+    from app.startup import StartupTimer, warm_up
+    timer = StartupTimer()
+
+    with timer.phase('config'):
+        app = Flask(__name__)
+        app.config.from_object(config_class)
+
+    with timer.phase('logging'):
+        from app.log import configure_logging
+        configure_logging(app)
+
+    with timer.phase('database'):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = get_engine_options(app.config)
+        db.init_app(app)
+        configure_sqlite(app.config, db.get_engine(app))
+        migrate.init_app(app, db)
+        from app import models
+
+    with timer.phase('routes'):
+        from app import routes
+        routes.init_app(app)
+
+    with timer.phase('commands'):
+        from app import commands
+        commands.init_app(app)
+
+    if app.config['WARMUP']:
+        with timer.phase('warmup'):
+            warm_up(app)
+
+    timer.report(app)
+    return app
@@ -0,0 +1,135 @@
+import functools, logging, random, threading, time
+from flask import current_app, make_response, render_template, request
+from app import db
+from app.metrics import timed_phase
+from app.session_token import get_session_token
+from app.utils import is_enrolled
+
+logger = logging.getLogger('vqg')
+
+##########
+#
+#   Admission control for new enrollments, per worker process.  Creating a user and
+#   selecting their first image are writes, so a burst of participants arriving when
+#   a study goes live can queue up behind the single SQLite writer and stall the
+#   participants who are already part way through.
+#
+#   At most max_enrollments new participants are enrolled at a time.  New
+#   participants also wait while max_active requests from participants already in
+#   the study are being served, so that those always go first.  A new participant
+#   waits up to timeout seconds for their turn, with at most max_waiting waiting at
+#   once; the others are told to come back later.
+#
+##########
+class AdmissionController(object):
+
+    def __init__(self, max_enrollments, max_active, max_waiting, timeout):
+        self.max_enrollments = max_enrollments
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.enrolling = 0
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _has_room(self):
+        return self.enrolling < self.max_enrollments and (not self.max_active or self.active < self.max_active)
+
+    def admit_participant(self):
+        with self._condition:
+            self.active += 1
+
+    def release_participant(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    ##########
+    #
+    #   Wait for room to enroll a new participant
+    #
+    #   Return:
+    #       admitted: True if the participant can be enrolled now, False if they have to
+    #           come back later
+    #
+    ##########
+    def admit_enrollment(self):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            if not self._has_room():
+                if self.waiting >= self.max_waiting:
+                    return False
+
+                self.waiting += 1
+                try:
+                    while not self._has_room():
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                        self._condition.wait(remaining)
+                finally:
+                    self.waiting -= 1
+
+            self.enrolling += 1
+            return True
+
+    def release_enrollment(self):
+        with self._condition:
+            self.enrolling -= 1
+            self._condition.notify_all()
+
+##########
+#
+#   Set up admission control if ADMISSION_MAX_ENROLLMENTS is above 0
+#
+##########
+def configure_admission(app):
+    if app.config['ADMISSION_MAX_ENROLLMENTS'] > 0:
+        app.extensions['admission'] = AdmissionController(app.config['ADMISSION_MAX_ENROLLMENTS'], app.config['ADMISSION_MAX_ACTIVE'],
+                                                          app.config['ADMISSION_MAX_WAITING'], app.config['ADMISSION_TIMEOUT'])
+
+##########
+#
+#   Put a view behind admission control.  Requests from participants who are not
+#   enrolled yet wait for their turn, and get a light "please wait" page that
+#   reloads itself after ADMISSION_RETRY_AFTER seconds (give or take, so that
+#   participants turned away together do not all come back together) if it does
+#   not come.  Requests without a Prolific ID are let straight through, to be turned
+#   away by the view.
+#
+##########
+def admission_control(view):
+    @functools.wraps(view)
+    def admitted_view(*args, **kwargs):
+        controller = current_app.extensions.get('admission')
+        user_id = request.args.get('PROLIFIC_PID')
+        if controller is None or not user_id:
+            return view(*args, **kwargs)
+
+        if get_session_token() or is_enrolled(user_id):
+            controller.admit_participant()
+            try:
+                return view(*args, **kwargs)
+            finally:
+                controller.release_participant()
+
+        # Hand the session's connection back to the pool before waiting, so that waiting
+        # participants never hold up the ones being served
+        db.session.close()
+        with timed_phase('admission'):
+            admitted = controller.admit_enrollment()
+
+        if not admitted:
+            retry_after = random.randint(current_app.config['ADMISSION_RETRY_AFTER'], 2 * current_app.config['ADMISSION_RETRY_AFTER'])
+            logger.info('User %s: Enrollment deferred, %s enrolling and %s waiting; retry after %ss', user_id, controller.enrolling, controller.waiting, retry_after)
+            response = make_response(render_template('wait.html', retry_after=retry_after), 503)
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+
+        try:
+            return view(*args, **kwargs)
+        finally:
+            controller.release_enrollment()
+
+    return admitted_view
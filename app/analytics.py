@@ -0,0 +1,319 @@
+import re
+from sqlalchemy import String, select, type_coerce
+from app import db
+from app.models import Annotation, Image, User
+
+# Questions are split into tokens in one pass per chunk of questions, joined with
+# QUESTION_END, which TOKEN_RE also matches to mark where each question ends
+QUESTION_END = '\0'
+TOKEN_RE = re.compile(r"[a-z0-9']+|\0")
+
+# The percentiles reported for distributions
+PERCENTILES = (10, 50, 90, 99)
+
+##########
+#
+#   The study loaded into NumPy arrays, with images and users numbered by their
+#   position in image_ids and user_ids:
+#       image_ids, image_excluded: the images, and whether each is excluded
+#       user_ids, user_progress, user_start, user_end: the users and their progress
+#           and start and end times (NaT where missing)
+#       ann_image, ann_user, ann_time: the image and user position and the timestamp
+#           of each annotation (-1 for annotations of unknown images or users)
+#       ann_tokens: the number of tokens in each annotation
+#       token_image, token_id: the image position and id (a hash of the token string)
+#           of each token
+#
+##########
+class StudyArrays(object):
+    pass
+
+##########
+#
+#   Load the images, users and annotations in bulk, reading chunk_size rows at a time
+#   straight into arrays rather than building ORM objects.  Timestamps are read as
+#   the database stores them and parsed by NumPy.
+#
+##########
+def load_study_arrays(chunk_size=100000):
+    np = _import_numpy()
+    arrays = StudyArrays()
+
+    connection = db.engine.raw_connection()
+    try:
+        columns = _read_columns(connection, select(Image.id, Image.img_xclude).order_by(Image.id), chunk_size)
+        arrays.image_ids = np.array(columns[0], dtype=np.int64)
+        arrays.image_excluded = np.array(columns[1], dtype=bool)
+
+        columns = _read_columns(connection, select(User.id, db.func.coalesce(User.progress, 0), type_coerce(User.start_time, String), type_coerce(User.end_time, String))
+                                .order_by(User.id), chunk_size)
+        arrays.user_ids = np.array(columns[0], dtype=np.int64)
+        arrays.user_progress = np.array(columns[1], dtype=np.int64)
+        arrays.user_start = np.array(columns[2], dtype='datetime64[us]')
+        arrays.user_end = np.array(columns[3], dtype='datetime64[us]')
+
+        chunks = []
+        query = select(db.func.coalesce(Annotation.image_id, -1), db.func.coalesce(Annotation.user_id, -1), type_coerce(Annotation.timestamp, String),
+                       db.func.coalesce(Annotation.q_content, ''))
+        for image_ids, user_ids, times, questions in _iter_chunks(connection, query, chunk_size):
+            n_tokens, token_ids = _tokenize(np, questions)
+            chunks.append((np.array(image_ids, dtype=np.int64), np.array(user_ids, dtype=np.int64), np.array(times, dtype='datetime64[us]'), n_tokens, token_ids))
+    finally:
+        connection.close()
+
+    image_ids, user_ids, times, n_tokens, token_ids = [np.concatenate(column) for column in zip(*chunks)] if chunks else \
+        [np.array([], dtype=np.int64), np.array([], dtype=np.int64), np.array([], dtype='datetime64[us]'), np.array([], dtype=np.int64), np.array([], dtype=np.int64)]
+
+    arrays.ann_image = _positions(np, arrays.image_ids, image_ids)
+    arrays.ann_user = _positions(np, arrays.user_ids, user_ids)
+    arrays.ann_time = times
+    arrays.ann_tokens = n_tokens
+    arrays.token_image = np.repeat(arrays.ann_image, n_tokens)
+    arrays.token_id = token_ids
+    return arrays
+
+##########
+#
+#   The image x user coverage matrix, in coordinate form: one (image, user) entry for
+#   each image that a user annotated
+#
+#   Return values:
+#       images, users: the image and user position of each entry
+#
+##########
+def coverage_matrix(arrays):
+    np = _import_numpy()
+    known = (arrays.ann_image >= 0) & (arrays.ann_user >= 0)
+    n_users = max(len(arrays.user_ids), 1)
+    entries = _unique(np, arrays.ann_image[known] * n_users + arrays.ann_user[known])
+    return entries // n_users, entries % n_users
+
+##########
+#
+#   The number of included images with each number of annotations, and with each
+#   number of annotators
+#
+##########
+def annotation_histogram(arrays):
+    np = _import_numpy()
+    included = ~arrays.image_excluded
+    annotations = np.bincount(arrays.ann_image[arrays.ann_image >= 0], minlength=len(arrays.image_ids))
+    annotators = np.bincount(coverage_matrix(arrays)[0], minlength=len(arrays.image_ids))
+    return _histogram(np, annotations[included]), _histogram(np, annotators[included])
+
+##########
+#
+#   The number of users at each progress step, and the number who got at least that
+#   far.  Users who failed the post-survey (progress -1) got as far as the survey.
+#
+##########
+def completion_funnel(arrays, progress_completion):
+    np = _import_numpy()
+    at_step = np.bincount(np.clip(arrays.user_progress, 0, progress_completion), minlength=progress_completion + 1)
+    failed = int((arrays.user_progress == -1).sum())
+    at_step[0] -= failed
+    reached = np.cumsum(at_step[::-1])[::-1]
+    reached[:progress_completion] += failed
+    return [{'step': step, 'at_step': int(at_step[step]), 'reached': int(reached[step])} for step in range(progress_completion + 1)] + [{'step': -1, 'at_step': failed, 'reached': failed}]
+
+##########
+#
+#   The time each user spent on each annotation step, from the previous step's
+#   annotations (or the user's start, for the first step) to the step's annotations,
+#   and on the survey, from the last annotations to the user's end time
+#
+#   Return:
+#       durations: {step: array of seconds}
+#
+##########
+def step_durations(arrays):
+    np = _import_numpy()
+    known = (arrays.ann_user >= 0) & ~np.isnat(arrays.ann_time)
+    users, images, times = arrays.ann_user[known], arrays.ann_image[known], arrays.ann_time[known]
+
+    # One entry per (user, image), at the time of its first annotation, in time order per user
+    order = np.lexsort((times, images, users))
+    users, images, times = users[order], images[order], times[order]
+    first = np.ones(len(users), dtype=bool)
+    first[1:] = (users[1:] != users[:-1]) | (images[1:] != images[:-1])
+    users, times = users[first], times[first]
+    order = np.lexsort((times, users))
+    users, times = users[order], times[order]
+
+    new_user = np.ones(len(users), dtype=bool)
+    new_user[1:] = users[1:] != users[:-1]
+    user_start = np.flatnonzero(new_user)
+    steps = np.arange(len(users)) - np.repeat(user_start, np.diff(np.append(user_start, len(users)))) + 1
+
+    previous = np.empty_like(times)
+    previous[1:] = times[:-1]
+    previous[new_user] = arrays.user_start[users[new_user]]
+    seconds = (times - previous) / np.timedelta64(1, 's')
+
+    durations = {}
+    for step in np.unique(steps):
+        values = seconds[steps == step]
+        durations[int(step)] = values[~np.isnan(values)]
+
+    # The survey, for the users who finished it
+    last = np.append(user_start[1:] - 1, len(users) - 1) if len(users) else np.array([], dtype=np.int64)
+    survey = (arrays.user_end[users[last]] - times[last]) / np.timedelta64(1, 's')
+    durations['survey'] = survey[~np.isnan(survey)]
+    return durations
+
+##########
+#
+#   Lexical diversity of each annotated image's questions: the number of distinct
+#   tokens over the number of tokens (the type-token ratio)
+#
+#   Return values:
+#       images: the positions of the images with at least one token
+#       diversity: the type-token ratio of each of those images
+#       n_tokens: the number of tokens of each of those images
+#
+##########
+def lexical_diversity(arrays):
+    np = _import_numpy()
+    known = arrays.token_image >= 0
+    token_image, token_id = arrays.token_image[known], arrays.token_id[known]
+
+    # Number the distinct tokens from 0, so that each (image, token) pair is one integer
+    vocabulary = _unique(np, token_id)
+    pairs = _unique(np, token_image * max(len(vocabulary), 1) + np.searchsorted(vocabulary, token_id))
+
+    n_tokens = np.bincount(token_image, minlength=len(arrays.image_ids))
+    n_types = np.bincount(pairs // max(len(vocabulary), 1), minlength=len(arrays.image_ids))
+
+    images = np.flatnonzero(n_tokens)
+    return images, n_types[images] / n_tokens[images], n_tokens[images]
+
+##########
+#
+#   Put the whole report together, as plain values that can be written out as JSON
+#
+##########
+def build_report(arrays, progress_completion, top=10):
+    np = _import_numpy()
+    annotations, annotators = annotation_histogram(arrays)
+    images, diversity, n_tokens = lexical_diversity(arrays)
+    lowest = np.lexsort((-n_tokens, diversity))[:top]
+
+    return {
+        'images': int((~arrays.image_excluded).sum()),
+        'excluded_images': int(arrays.image_excluded.sum()),
+        'users': len(arrays.user_ids),
+        'annotations': len(arrays.ann_image),
+        'annotations_per_image': annotations,
+        'annotators_per_image': annotators,
+        'funnel': completion_funnel(arrays, progress_completion),
+        'step_seconds': dict((str(step), _distribution(np, values)) for step, values in step_durations(arrays).items()),
+        'tokens_per_annotation': _distribution(np, arrays.ann_tokens),
+        'lexical_diversity': _distribution(np, diversity),
+        'least_diverse_images': [{'image_id': int(arrays.image_ids[images[i]]), 'diversity': round(float(diversity[i]), 3), 'tokens': int(n_tokens[i])} for i in lowest],
+    }
+
+def format_report(report):
+    lines = [f"{report['images']} images ({report['excluded_images']} excluded), {report['users']} users, {report['annotations']} annotations", '']
+
+    for name, label in [('annotations_per_image', 'annotations'), ('annotators_per_image', 'annotators')]:
+        lines.append(f'Included images by number of {label}:')
+        for row in report[name]:
+            lines.append(f"    {row['n']:>6} {label:<12} {row['images']:>8} images")
+        lines.append('')
+
+    lines.append('Completion funnel (users at each progress step / reaching it):')
+    for row in report['funnel']:
+        label = 'failed' if row['step'] == -1 else f"step {row['step']}"
+        lines.append(f"    {label:<8} {row['at_step']:>8} {row['reached']:>8}")
+
+    lines += ['', 'Seconds per step' + ''.join(f'{f"p{p}":>10}' for p in PERCENTILES) + f'{"n":>10}']
+    for step, dist in report['step_seconds'].items():
+        lines.append(f"    {step:<12}" + ''.join(f'{dist[f"p{p}"]:>10.1f}' for p in PERCENTILES) + f"{dist['n']:>10}")
+
+    for name in ('tokens_per_annotation', 'lexical_diversity'):
+        dist = report[name]
+        lines += ['', name.replace('_', ' ').capitalize() + ': ' + ', '.join(f'p{p} {dist[f"p{p}"]:.2f}' for p in PERCENTILES) + f", mean {dist['mean']:.2f}"]
+
+    lines += ['', 'Least diverse images:']
+    for row in report['least_diverse_images']:
+        lines.append(f"    image {row['image_id']:>8}: diversity {row['diversity']:.3f} over {row['tokens']} tokens")
+
+    return lines
+
+##########
+#
+#   Run a query on a DBAPI connection and yield its rows chunk by chunk, as a tuple of
+#   columns.  Reading from the DBAPI cursor directly skips building a SQLAlchemy row
+#   for every row.
+#
+##########
+def _iter_chunks(connection, query, chunk_size):
+    cursor = connection.cursor()
+    try:
+        cursor.execute(str(query.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})))
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield tuple(zip(*rows))
+    finally:
+        cursor.close()
+
+def _read_columns(connection, query, chunk_size):
+    columns = [[] for column in query.selected_columns]
+    for chunk in _iter_chunks(connection, query, chunk_size):
+        for column, values in zip(columns, chunk):
+            column.extend(values)
+    return columns
+
+##########
+#
+#   Split a chunk of questions into tokens
+#
+#   Return values:
+#       n_tokens: the number of tokens in each question
+#       token_ids: the id of each token, a hash of the token string
+#
+##########
+def _tokenize(np, questions):
+    tokens = TOKEN_RE.findall((QUESTION_END.join(questions) + QUESTION_END).lower())
+    is_end = np.fromiter(map(QUESTION_END.__eq__, tokens), dtype=bool, count=len(tokens))
+    n_tokens = np.diff(np.flatnonzero(is_end), prepend=-1) - 1
+    token_ids = np.fromiter(map(hash, tokens), dtype=np.int64, count=len(tokens))
+    return n_tokens, token_ids[~is_end]
+
+# The position of each id in sorted_ids, or -1 for ids that are not there
+def _positions(np, sorted_ids, ids):
+    if not len(sorted_ids):
+        return np.full(len(ids), -1, dtype=np.int64)
+    positions = np.minimum(np.searchsorted(sorted_ids, ids), len(sorted_ids) - 1)
+    return np.where(sorted_ids[positions] == ids, positions, -1)
+
+# Sorting is much faster than np.unique for large integer arrays
+def _unique(np, values):
+    values = np.sort(values)
+    distinct = np.ones(len(values), dtype=bool)
+    distinct[1:] = values[1:] != values[:-1]
+    return values[distinct]
+
+def _histogram(np, values):
+    counts = np.bincount(values) if len(values) else np.array([], dtype=np.int64)
+    return [{'n': n, 'images': int(count)} for n, count in enumerate(counts) if count]
+
+def _distribution(np, values):
+    if not len(values):
+        return dict([(f'p{p}', 0.0) for p in PERCENTILES] + [('mean', 0.0), ('n', 0)])
+    percentiles = np.percentile(values, PERCENTILES)
+    return dict([(f'p{p}', float(value)) for p, value in zip(PERCENTILES, percentiles)] + [('mean', float(np.mean(values))), ('n', len(values))])
+
+##########
+#
+#   The analytics need NumPy, which is not installed with the application
+#
+##########
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ValueError('flask analytics needs numpy: pip install numpy')
+    return numpy
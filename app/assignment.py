@@ -0,0 +1,366 @@
+import logging, random, threading, time
+from datetime import datetime, timedelta
+from flask import current_app
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from app import db
+from app.models import Image, ImageChange, SessionPlan, User
+from app.sampler import SYNC_CHUNK_SIZE, get_sampler
+
+logger = logging.getLogger('vqg')
+
+# The number of images to try to reserve before giving up on exact counts, when other
+# worker processes keep changing the images picked
+RESERVE_ATTEMPTS = 5
+
+##########
+#
+#   Reserve an image that is not in excluded, picked by ImageSampler priority, counting
+#   the assignment toward the image's load so that every worker process steers later
+#   participants elsewhere.
+#
+#   The image is picked from this process's ImageSampler, which may be a few seconds
+#   behind the other workers, so the reservation is a conditional update that only
+#   succeeds if the image's counts in the database are still the ones it was picked at.
+#   If another worker got there first, the image is re-read and another one picked.
+#   The reservation is committed in its own short transaction, so it is visible to the
+#   other workers at once, and logged in image_change so their samplers catch up.
+#
+#   The caller hands the reservation to the user with assign_lease.
+#
+#   Return:
+#       image_id: the reserved image id, or None if every image is excluded
+#
+##########
+def reserve_image(excluded):
+    image_ids = reserve_images(excluded, 1)
+    return image_ids[0] if image_ids else None
+
+##########
+#
+#   Reserve up to n different images that are not in excluded, the same way as 
+#   reserve_image but all in one transaction
+#
+#   Return:
+#       image_ids: the reserved image ids, fewer than n if there are not enough images
+#
+##########
+def reserve_images(excluded, n):
+    sampler = get_sampler()
+
+    def reserve(conn):
+        image_ids = []
+        for i in range(n):
+            image_id = _reserve_one(conn, sampler, set(excluded).union(image_ids))
+            if image_id is None:
+                break
+            image_ids.append(image_id)
+        return image_ids
+
+    image_ids = _run_transaction(reserve)
+    for image_id in image_ids:
+        sampler.add(image_id, reservations=1)
+    return image_ids
+
+##########
+#
+#   Plan the images for a new user's annotation steps 1 to n_steps: reserve them all 
+#   at once, hand the first to the user with assign_lease, and keep the rest in the 
+#   user's session plan, to be picked up by take_planned_image.  The plan rows are 
+#   written with the user, as part of the caller's transaction.
+#
+#   Return:
+#       image_ids: the reserved image ids, to release if the caller's transaction fails
+#
+##########
+def plan_session(u, n_steps):
+    image_ids = reserve_images(set(), n_steps)
+    assign_lease(u, image_ids[0] if image_ids else None)
+    for step, image_id in enumerate(image_ids[1:], start=2):
+        u.session_plan.append(SessionPlan(step=step, image_id=image_id))
+    return image_ids
+
+##########
+#
+#   Hand the image planned for the user's annotation step to the user with 
+#   assign_lease, as part of the caller's transaction.  The plan row's reservation 
+#   becomes the lease, so the image's reserved_count stays as it is.  An image that 
+#   has been excluded since it was planned is given back instead.
+#
+#   Return:
+#       planned: True if the user was given the planned image, False if there is none
+#
+##########
+def take_planned_image(u, step):
+    with db.session.no_autoflush:
+        row = db.session.query(SessionPlan, Image.img_xclude).join(Image, SessionPlan.image_id == Image.id) \
+            .filter(SessionPlan.user_id == u.id, SessionPlan.step == step).first()
+    if row is None:
+        return False
+
+    plan, img_xclude = row
+    db.session.delete(plan)
+    if img_xclude:
+        with db.session.no_autoflush:
+            image = Image.query.get(plan.image_id)
+        image.reserved_count = Image.reserved_count - 1
+        db.session.add(ImageChange(image_id=image.id))
+        logger.info('User %s: planned image %s has been excluded', u.prolific_id, plan.image_id)
+        return False
+
+    assign_lease(u, plan.image_id)
+    logger.info('User %s: take planned image %s for step %s', u.prolific_id, plan.image_id, step)
+    return True
+
+##########
+#
+#   Release a reservation made by reserve_image that was never handed to a user, e.g.
+#   because the transaction that assigns it failed
+#
+##########
+def release_image(image_id):
+    def release(conn):
+        released = conn.execute(Image.__table__.update().where(Image.id == image_id, Image.reserved_count > 0)
+                                .values(reserved_count=Image.reserved_count - 1)).rowcount == 1
+        if released:
+            conn.execute(ImageChange.__table__.insert().values(image_id=image_id, timestamp=datetime.utcnow()))
+        return released
+
+    if _run_transaction(release):
+        get_sampler().add(image_id, reservations=-1)
+
+##########
+#
+#   Hand a reserved image to the user with a lease that expires after
+#   IMAGE_LEASE_SECONDS, as part of the caller's transaction.  A participant who drops
+#   out stops renewing the lease, and sweep_expired_leases then gives the image back.
+#
+##########
+def assign_lease(u, image_id):
+    u.current_image_id = image_id
+    u.reserved_image_id = image_id
+    u.reservation_expires_at = None if image_id is None else datetime.utcnow() + timedelta(seconds=current_app.config['IMAGE_LEASE_SECONDS'])
+
+##########
+#
+#   Extend the lease on the user's current image once half of it has run out, as part
+#   of the caller's transaction.  If the lease has already been swept, the image is
+#   reserved for the user again.
+#
+#   Return:
+#       renewed: True if the user's lease was changed and needs to be committed
+#
+##########
+def renew_lease(u):
+    if u.current_image_id is None:
+        return False
+
+    lease = timedelta(seconds=current_app.config['IMAGE_LEASE_SECONDS'])
+    now = datetime.utcnow()
+
+    if u.reserved_image_id is None:
+        with db.session.no_autoflush:
+            image = Image.query.get(u.current_image_id)
+        if image is None:
+            return False
+        image.reserved_count = Image.reserved_count + 1
+        db.session.add(ImageChange(image_id=image.id))
+        get_sampler().add(image.id, reservations=1)
+        u.reserved_image_id = image.id
+        logger.info('User %s: reserving swept image %s again', u.prolific_id, image.id)
+
+    elif u.reservation_expires_at is not None and u.reservation_expires_at - now > lease / 2:
+        return False
+
+    u.reservation_expires_at = now + lease
+    return True
+
+##########
+#
+#   Release the user's reservation as part of the caller's transaction, once the user
+#   has annotated the image (or, in any case, no longer needs it).
+#
+#   The image's reserved_count is recounted from the users that still hold a
+#   reservation on it (or have it planned), rather than decremented, so a reservation 
+#   that the sweeper releases at the same moment is never subtracted twice.
+#
+##########
+def release_reservation(u, annotated_image=None):
+    if u.reserved_image_id is None:
+        return
+
+    with db.session.no_autoflush:
+        image = annotated_image if annotated_image is not None and annotated_image.id == u.reserved_image_id else Image.query.get(u.reserved_image_id)
+
+    if image is not None:
+        image.reserved_count = _count_reservations(image.id, excluded_user_id=u.id)
+        if image is not annotated_image:
+            db.session.add(ImageChange(image_id=image.id))
+        get_sampler().add(image.id, reservations=-1)
+
+    u.reserved_image_id = None
+    u.reservation_expires_at = None
+
+##########
+#
+#   Release every lease that expired before now, along with the rest of those users'
+#   session plans, in one transaction, recount the reservations of the images 
+#   involved from the users that still hold them, and log the images so that every 
+#   worker's sampler picks them up again.
+#
+#   Leases only ever expire (renewals and new leases end in the future), so the users
+#   found with an expired lease are a superset of those released.
+#
+#   Return:
+#       n_released: the number of leases released
+#
+##########
+def sweep_expired_leases(now=None):
+    now = now or datetime.utcnow()
+
+    def sweep(conn):
+        expired = User.reservation_expires_at < now
+        planned = SessionPlan.user_id.in_(select(User.id).where(expired))
+        image_ids = set(image_id for image_id, in conn.execute(select(User.reserved_image_id).where(expired).distinct()))
+        image_ids.update(image_id for image_id, in conn.execute(select(SessionPlan.image_id).where(planned).distinct()))
+        image_ids = sorted(image_id for image_id in image_ids if image_id is not None)
+        if not image_ids:
+            return 0, image_ids
+
+        conn.execute(SessionPlan.__table__.delete().where(planned))
+        n_released = conn.execute(User.__table__.update().where(expired).values(reserved_image_id=None, reservation_expires_at=None)).rowcount
+
+        reserved_count = _count_reservations(Image.id)
+        for i in range(0, len(image_ids), SYNC_CHUNK_SIZE):
+            conn.execute(Image.__table__.update().where(Image.id.in_(image_ids[i:i + SYNC_CHUNK_SIZE])).values(reserved_count=reserved_count))
+        conn.execute(ImageChange.__table__.insert(), [{'image_id': image_id, 'timestamp': now} for image_id in image_ids])
+        return n_released, image_ids
+
+    n_released, image_ids = _run_transaction(sweep)
+    if not image_ids:
+        return 0
+
+    logger.info('sweep_expired_leases released %s leases on %s images', n_released, len(image_ids))
+    return n_released
+
+##########
+#
+#   Delete the image_change rows logged more than IMAGE_CHANGE_RETENTION seconds ago, 
+#   which every worker's sampler has long since applied (a sampler that has not synced
+#   for that long reloads instead, see sampler.get_sampler).  The latest row is always
+#   kept, so that SQLite never hands out a change id that a sampler has already seen.
+#
+#   Return:
+#       n_deleted: the number of rows deleted
+#
+##########
+def prune_image_changes(now=None):
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=current_app.config['IMAGE_CHANGE_RETENTION'])
+    latest = select(db.func.max(ImageChange.id)).scalar_subquery()
+
+    def prune(conn):
+        return conn.execute(ImageChange.__table__.delete().where(ImageChange.timestamp < cutoff, ImageChange.id < latest)).rowcount
+
+    n_deleted = _run_transaction(prune)
+    if n_deleted:
+        logger.info('prune_image_changes deleted %s image changes', n_deleted)
+    return n_deleted
+
+##########
+#
+#   Sweep expired leases, and prune the image_change log, every LEASE_SWEEP_INTERVAL 
+#   seconds on a daemon thread.  Every worker process runs one; both are idempotent, 
+#   so it does not matter which worker gets there first.
+#
+##########
+class LeaseSweeper(threading.Thread):
+
+    def __init__(self, app):
+        super().__init__(name='vqg-lease-sweeper', daemon=True)
+        self.app = app
+        self.interval = app.config['LEASE_SWEEP_INTERVAL']
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.app.app_context():
+                try:
+                    sweep_expired_leases()
+                    prune_image_changes()
+                except Exception:
+                    logger.exception('LeaseSweeper could not sweep expired leases')
+                finally:
+                    db.session.remove()
+
+def start_lease_sweeper(app):
+    if app.config['LEASE_SWEEP_INTERVAL'] > 0:
+        LeaseSweeper(app).start()
+
+def _reserve_one(conn, sampler, excluded):
+    for attempt in range(RESERVE_ATTEMPTS):
+        image_id = sampler.sample(excluded)
+        if image_id is None:
+            return None
+
+        if _reserve(conn, image_id, sampler.counts(image_id)):
+            return image_id
+
+        _refresh(conn, sampler, image_id)
+
+    # Under heavy contention, settle for any image picked that is still included
+    logger.warning('reserve_image: no exact reservation after %s attempts', RESERVE_ATTEMPTS)
+    image_id = sampler.sample(excluded)
+    while image_id is not None and not _reserve(conn, image_id):
+        _refresh(conn, sampler, image_id)
+        image_id = sampler.sample(excluded)
+    return image_id
+
+def _reserve(conn, image_id, counts=None):
+    conditions = [Image.id == image_id, Image.img_xclude == False]
+    if counts is not None:
+        conditions += [Image.annotation_count == counts[0], Image.reserved_count == counts[1]]
+
+    reserved = conn.execute(Image.__table__.update().where(*conditions).values(reserved_count=Image.reserved_count + 1)).rowcount == 1
+    if reserved:
+        conn.execute(ImageChange.__table__.insert().values(image_id=image_id, timestamp=datetime.utcnow()))
+    return reserved
+
+def _refresh(conn, sampler, image_id):
+    row = conn.execute(select(Image.annotation_count, Image.reserved_count, Image.img_xclude).where(Image.id == image_id)).first()
+    sampler.set(image_id, None if row is None or row.img_xclude else (row.annotation_count, row.reserved_count))
+
+##########
+#
+#   The number of reservations of image_id (a value or a correlated column): the users 
+#   holding a lease on it, other than excluded_user_id, plus the session plans that 
+#   include it
+#
+##########
+def _count_reservations(image_id, excluded_user_id=None):
+    held = select(db.func.count(User.id)).where(User.reserved_image_id == image_id)
+    if excluded_user_id is not None:
+        held = held.where(User.id != excluded_user_id)
+    planned = select(db.func.count(SessionPlan.id)).where(SessionPlan.image_id == image_id)
+    return held.scalar_subquery() + planned.scalar_subquery()
+
+##########
+#
+#   Run fn(conn) in its own transaction.  Like utils._try_commit, a transaction that
+#   finds the database locked by another writer is retried up to COMMIT_RETRIES times,
+#   backing off exponentially (with jitter) from COMMIT_RETRY_BACKOFF seconds.
+#
+##########
+def _run_transaction(fn):
+    retries = current_app.config['COMMIT_RETRIES']
+
+    for attempt in range(retries + 1):
+        try:
+            with db.engine.begin() as conn:
+                return fn(conn)
+        except OperationalError as err:
+            if attempt == retries or not 'database is locked' in str(err):
+                raise
+
+            delay = current_app.config['COMMIT_RETRY_BACKOFF'] * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning('_run_transaction: database is locked, retrying in %.3fs (attempt %s of %s)', delay, attempt + 1, retries)
+            time.sleep(delay)
@@ -0,0 +1,279 @@
+import json, os, re, time
+from datetime import datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import AppGroup, with_appcontext
+from sqlalchemy import text
+from app import db
+from app.analytics import build_report, format_report, load_study_arrays
+from app.assignment import prune_image_changes, sweep_expired_leases
+from app.export import EXPORT_FORMATS, export_annotations, read_watermark, write_watermark
+from app.journal import read_journal, rebuild_from_journal, verify_journal
+from app.log_analysis import LogAnalyzer, format_report as format_log_report, open_log
+from app.utils import get_progress_completion
+
+##########
+#
+#   flask images exclude|include ID_FILE...
+#
+#   Exclude images from (or return them to) image selection.  Excluded images stay in
+#   the image table, so users who are already looking at one can still finish it.
+#
+##########
+@click.group(cls=AppGroup)
+def images():
+    """Manage the images that participants are shown."""
+
+@images.command('exclude')
+@click.argument('id_files', nargs=-1, required=True, type=click.File())
+def exclude_images(id_files):
+    """Exclude the images whose ids are listed in ID_FILES."""
+    _report(*set_images_excluded(read_image_ids(id_files), True), 'excluded')
+
+@images.command('include')
+@click.argument('id_files', nargs=-1, required=True, type=click.File())
+def include_images(id_files):
+    """Return the images whose ids are listed in ID_FILES to image selection."""
+    _report(*set_images_excluded(read_image_ids(id_files), False), 'included')
+
+def _report(n_changed, unknown_ids, action):
+    click.echo(f'{n_changed} images {action}')
+    if unknown_ids:
+        click.echo(f'{len(unknown_ids)} ids are not in the image table: {" ".join(str(image_id) for image_id in sorted(unknown_ids))}')
+
+##########
+#
+#   Read image ids from files with any number of ids per line, separated by whitespace
+#   or commas.  Everything after a # on a line is ignored.
+#
+##########
+def read_image_ids(id_files):
+    image_ids = set()
+    for id_file in id_files:
+        for line in id_file:
+            image_ids.update(int(image_id) for image_id in re.findall(r'\d+', line.partition('#')[0]))
+    return image_ids
+
+##########
+#
+#   Set img_xclude for all of the passed images with one set-based update, and log the
+#   changed images so that each worker's ImageSampler applies the change incrementally.
+#   The ids are staged in a temporary table so that there is no limit on how many
+#   images can be changed at once.
+#
+#   Return values:
+#       n_changed: the number of images whose exclusion flag changed
+#       unknown_ids: the passed ids that are not in the image table
+#
+##########
+def set_images_excluded(image_ids, excluded):
+    conn = db.session.connection()
+    conn.execute(text('CREATE TEMP TABLE IF NOT EXISTS image_id_list (id INTEGER PRIMARY KEY)'))
+    conn.execute(text('DELETE FROM image_id_list'))
+    if image_ids:
+        conn.execute(text('INSERT INTO image_id_list (id) VALUES (:id)'), [{'id': image_id} for image_id in image_ids])
+
+    unknown_ids = set(image_id for image_id, in conn.execute(text('SELECT id FROM image_id_list WHERE id NOT IN (SELECT id FROM image)')))
+
+    conn.execute(text('INSERT INTO image_change (image_id, timestamp) '
+                      'SELECT id, :timestamp FROM image WHERE img_xclude != :excluded AND id IN (SELECT id FROM image_id_list)'),
+                 {'timestamp': datetime.utcnow(), 'excluded': excluded})
+    n_changed = conn.execute(text('UPDATE image SET img_xclude = :excluded '
+                                  'WHERE img_xclude != :excluded AND id IN (SELECT id FROM image_id_list)'),
+                             {'excluded': excluded}).rowcount
+
+    conn.execute(text('DELETE FROM image_id_list'))
+    db.session.commit()
+    return n_changed, unknown_ids
+
+##########
+#
+#   flask export OUTPUT [--format csv|jsonl|parquet] [--key id|timestamp] [--since VALUE] [--watermark FILE]
+#
+#   Export the annotations, with their user and image, for analysis.  With --watermark,
+#   only the annotations added since the last export with the same watermark file are
+#   exported, and the file is updated once the export is complete, e.g. for nightly
+#   exports.  Only --key id never misses an annotation: timestamps are set before the
+#   commit, which may be retried, so keyed on timestamp the last --lag seconds of
+#   annotations are left for the next export.
+#
+##########
+@click.command('export')
+@click.argument('output', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(EXPORT_FORMATS), help='The output format (default: from the OUTPUT extension, or csv).')
+@click.option('--key', type=click.Choice(['id', 'timestamp']), default='id', show_default=True, help='The column that incremental exports are keyed on.  Only id is guaranteed not to miss annotations that were being committed during an export.')
+@click.option('--since', help='Only export annotations after this annotation id (or, keyed on timestamp, from this ISO timestamp on).')
+@click.option('--watermark', type=click.Path(dir_okay=False), help='A file recording the last exported annotation; only later annotations are exported, and the file is updated afterwards.')
+@click.option('--lag', type=float, default=60, show_default=True, help='Keyed on timestamp, leave the annotations from the last LAG seconds for the next export; this should exceed the longest a commit can take, with its retries.')
+@click.option('--chunk_size', type=int, default=5000, show_default=True, help='The number of rows read from the database at a time.')
+@with_appcontext
+def export(output, fmt, key, since, watermark, lag, chunk_size):
+    """Export the annotations to OUTPUT ('-' for stdout)."""
+    if fmt is None:
+        extension = os.path.splitext(output)[1].lstrip('.').lower()
+        fmt = extension if extension in EXPORT_FORMATS else 'csv'
+
+    try:
+        if since is not None:
+            since = int(since) if key == 'id' else (datetime.fromisoformat(since), 0)
+        elif watermark:
+            since = read_watermark(watermark, key)
+    except ValueError as err:
+        raise click.BadParameter(str(err))
+
+    until = datetime.utcnow() - timedelta(seconds=lag) if key == 'timestamp' else None
+
+    start = time.perf_counter()
+    try:
+        n_rows, new_watermark = export_annotations(output, fmt, key, since, chunk_size, stdout=click.get_text_stream('stdout'), until=until)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+
+    if watermark and new_watermark:
+        write_watermark(watermark, new_watermark)
+
+    click.echo(f'Exported {n_rows} annotations in {time.perf_counter() - start:.2f}s', err=True)
+
+##########
+#
+#   flask images sweep
+#
+#   Release the image leases of participants who have dropped out, and prune the
+#   image_change log.  Worker processes do this every LEASE_SWEEP_INTERVAL seconds; run
+#   this from cron instead if the interval is set to 0.
+#
+##########
+@images.command('sweep')
+def sweep_leases():
+    """Release expired image leases and prune old image changes."""
+    click.echo(f'{sweep_expired_leases()} expired leases released')
+    click.echo(f'{prune_image_changes()} old image changes pruned')
+
+##########
+#
+#   flask analytics [--json]
+#
+#   Report on the study so far: how many annotations and annotators each image has,
+#   how far users got, how long they took over each step, and how varied each
+#   image's questions are.  The tables are loaded in bulk into NumPy arrays, which
+#   needs pip install numpy.
+#
+##########
+@click.command('analytics')
+@click.option('--json', 'as_json', is_flag=True, help='Write the report as JSON.')
+@click.option('--top', type=int, default=10, show_default=True, help='The number of least diverse images to list.')
+@click.option('--chunk_size', type=int, default=100000, show_default=True, help='The number of rows read from the database at a time.')
+@with_appcontext
+def analytics(as_json, top, chunk_size):
+    """Report on image coverage, completion, step times and question diversity."""
+    start = time.perf_counter()
+    try:
+        report = build_report(load_study_arrays(chunk_size), get_progress_completion(), top)
+    except ValueError as err:
+        raise click.ClickException(str(err))
+
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        click.echo('\n'.join(format_report(report)))
+    click.echo(f'Analysed {report["annotations"]} annotations in {time.perf_counter() - start:.2f}s', err=True)
+
+##########
+#
+#   flask journal verify|rebuild [--journal FILE]
+#
+#   Replay the journal of participant state transitions (JOURNAL_FILE), and either
+#   compare the users, annotations and image annotation counts in the database with it,
+#   or replace them with it, e.g. after the database was corrupted.  Stop the app
+#   before rebuilding.
+#
+##########
+@click.group(cls=AppGroup)
+def journal():
+    """Verify or rebuild the database from the journal."""
+
+def _read_journal(path):
+    path = path or current_app.config['JOURNAL_FILE']
+    if not path or not os.path.exists(path) or not os.path.getsize(path):
+        raise click.ClickException(f'There is no journal at {path!r}, or it is empty')
+
+    start = time.perf_counter()
+    state = read_journal(path)
+    click.echo(f'Replayed {state.events} events ({len(state.users)} users, {len(state.annotations)} annotations) in {time.perf_counter() - start:.2f}s', err=True)
+    if state.skipped:
+        click.echo(f'Skipped {state.skipped} lines that could not be read', err=True)
+    return state
+
+@journal.command('verify')
+@click.option('--journal', 'path', type=click.Path(dir_okay=False), help='The journal file (default: JOURNAL_FILE).')
+@click.option('--limit', type=int, default=20, show_default=True, help='The number of differences to list.')
+def verify(path, limit):
+    """Compare the database with the journal."""
+    differences = verify_journal(_read_journal(path))
+    for difference in differences[:limit]:
+        click.echo(difference)
+
+    if differences:
+        raise click.ClickException(f'{len(differences)} differences between the database and the journal')
+    click.echo('The database matches the journal')
+
+@journal.command('rebuild')
+@click.option('--journal', 'path', type=click.Path(dir_okay=False), help='The journal file (default: JOURNAL_FILE).')
+@click.option('--yes', is_flag=True, help='Do not ask for confirmation.')
+def rebuild(path, yes):
+    """Replace the users and annotations in the database with the journal's."""
+    state = _read_journal(path)
+    if not yes:
+        click.confirm(f'Replace all users and annotations in the database with the {len(state.users)} users and {len(state.annotations)} annotations in the journal?', abort=True)
+
+    start = time.perf_counter()
+    n_users, n_annotations = rebuild_from_journal(state)
+    click.echo(f'Restored {n_users} users and {n_annotations} annotations in {time.perf_counter() - start:.2f}s')
+
+##########
+#
+#   flask logs LOG_FILE... [--json] [--timelines FILE] [--profile FILE]
+#
+#   Follow each participant through vqg.log (text or JSON lines; rotated .gz logs too)
+#   and report the latency of each kind of request and the time participants spent on
+#   each step.  The log is read one line at a time, so logs of any size can be read.
+#   --timelines writes each participant's timeline as JSON lines, and --profile writes
+#   when each participant arrived and how long they took over each step, which
+#   benchmarks/load_test.py --profile replays.
+#
+##########
+@click.command('logs')
+@click.argument('log_files', nargs=-1, required=True, type=click.Path(exists=True, dir_okay=False, allow_dash=True))
+@click.option('--json', 'as_json', is_flag=True, help='Write the report as JSON.')
+@click.option('--timelines', type=click.File('w'), help='Write each participant\'s timeline to this file, as JSON lines.')
+@click.option('--profile', type=click.File('w'), help='Write a load profile for benchmarks/load_test.py to this file, as JSON lines.')
+@click.option('--idle', type=float, default=900, show_default=True, help='The seconds after which a participant with nothing logged is taken to have left.')
+def logs(log_files, as_json, timelines, profile, idle):
+    """Report request latencies and step times from LOG_FILES ('-' for stdin)."""
+    write_line = lambda f: (lambda entry: f.write(json.dumps(entry) + '\n'))
+    analyzer = LogAnalyzer(get_progress_completion(), idle, on_timeline=write_line(timelines) if timelines else None,
+                           on_profile=write_line(profile) if profile else None)
+
+    start = time.perf_counter()
+    for path in log_files:
+        f = open_log(path)
+        try:
+            analyzer.read(f)
+        finally:
+            if not path == '-':
+                f.close()
+    analyzer.finish()
+
+    report = analyzer.report()
+    if as_json:
+        click.echo(json.dumps(report, indent=2))
+    else:
+        click.echo('\n'.join(format_log_report(report)))
+    click.echo(f'Read {analyzer.lines} lines in {time.perf_counter() - start:.2f}s', err=True)
+
+def init_app(app):
+    app.cli.add_command(images)
+    app.cli.add_command(export)
+    app.cli.add_command(analytics)
+    app.cli.add_command(journal)
+    app.cli.add_command(logs)
@@ -0,0 +1,57 @@
+import gzip
+from flask import request
+
+# The content types worth compressing; images are compressed already
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain', 'text/javascript', 'application/javascript', 'application/json')
+
+##########
+#
+#   Compress responses if COMPRESSION_ENABLED is set, with brotli for browsers that
+#   accept it (if the brotli package is installed) and gzip otherwise.  Only
+#   successful text responses of at least COMPRESSION_MIN_SIZE bytes are compressed.
+#   Files sent straight from disk, such as the images, are left alone.
+#
+##########
+def configure_compression(app):
+    if not app.config['COMPRESSION_ENABLED']:
+        return
+
+    encoders = _get_encoders(app.config)
+
+    @app.after_request
+    def compress_response(response):
+        if response.status_code != 200 or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+
+        if not response.mimetype in COMPRESSIBLE_TYPES:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = _choose_encoding(encoders)
+        data = response.get_data()
+        if encoding is None or len(data) < app.config['COMPRESSION_MIN_SIZE']:
+            return response
+
+        response.set_data(encoders[encoding](data))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+##########
+#
+#   Brotli needs the brotli package, which is not installed with the application
+#
+##########
+def _get_encoders(config):
+    encoders = {'gzip': lambda data: gzip.compress(data, compresslevel=config['GZIP_LEVEL'])}
+
+    try:
+        import brotli
+        encoders['br'] = lambda data: brotli.compress(data, quality=config['BROTLI_QUALITY'])
+    except ImportError:
+        pass
+
+    return encoders
+
+def _choose_encoding(encoders):
+    accepted = [(request.accept_encodings[encoding], encoding == 'br', encoding) for encoding in encoders if request.accept_encodings[encoding]]
+    return max(accepted)[2] if accepted else None
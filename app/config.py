@@ -1,6 +1,60 @@
 import os
 
+# The SECRET_KEY used when none is set, which anyone can sign session tokens with
+DEFAULT_SECRET_KEY = 'you-will-never-guess'
+
+# Settings that are not set, or set to an empty value, take their defaults
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else int(value)
+
+def _env_float(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else float(value)
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    return default if value in (None, '') else value.lower() in ('1', 'true', 'yes', 'on')
+
 class Config(object):
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
-    SECRET_KEY = os.environ.get('SECRET_KEY') or 'you-will-never-guess'
\ No newline at end of file
+    SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+    SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+    SQLITE_BUSY_TIMEOUT = _env_int('SQLITE_BUSY_TIMEOUT', 5000)
+    DB_POOL_SIZE = _env_int('DB_POOL_SIZE', 10)
+    DB_MAX_OVERFLOW = _env_int('DB_MAX_OVERFLOW', 20)
+    COMMIT_RETRIES = _env_int('COMMIT_RETRIES', 3)
+    COMMIT_RETRY_BACKOFF = _env_float('COMMIT_RETRY_BACKOFF', 0.05)
+    SECRET_KEY = os.environ.get('SECRET_KEY') or DEFAULT_SECRET_KEY
+    IMAGE_SAMPLER_SYNC_INTERVAL = _env_int('IMAGE_SAMPLER_SYNC_INTERVAL', 5)
+    IMAGE_LEASE_SECONDS = _env_int('IMAGE_LEASE_SECONDS', 900)
+    LEASE_SWEEP_INTERVAL = _env_int('LEASE_SWEEP_INTERVAL', 60)
+    IMAGE_CHANGE_RETENTION = _env_int('IMAGE_CHANGE_RETENTION', 3600)
+    TARGET_ANNOTATIONS = _env_int('TARGET_ANNOTATIONS', 0)
+    SESSION_PLAN = _env_bool('SESSION_PLAN', False)
+    SESSION_TOKENS = _env_bool('SESSION_TOKENS', True)
+    SESSION_TOKEN_MAX_AGE = _env_int('SESSION_TOKEN_MAX_AGE', 60)
+    NEAR_DUPLICATE_THRESHOLD = _env_float('NEAR_DUPLICATE_THRESHOLD', 0.8)
+    QUESTION_INDEX_PATH = os.environ.get('QUESTION_INDEX_PATH') or 'vqg_questions.idx'
+    QUESTION_INDEX_SYNC_INTERVAL = _env_int('QUESTION_INDEX_SYNC_INTERVAL', 5)
+    QUESTION_INDEX_SAVE_EVERY = _env_int('QUESTION_INDEX_SAVE_EVERY', 1000)
+    JOURNAL_FILE = os.environ.get('JOURNAL_FILE', 'vqg_journal.jsonl')
+    JOURNAL_FSYNC = _env_bool('JOURNAL_FSYNC', True)
+    JOURNAL_TIMEOUT = _env_float('JOURNAL_TIMEOUT', 5)
+    LOG_FILE = os.environ.get('LOG_FILE') or 'vqg.log'
+    LOG_LEVEL = os.environ.get('LOG_LEVEL') or 'INFO'
+    LOG_FORMAT = os.environ.get('LOG_FORMAT') or 'text'
+    LOG_MODE = os.environ.get('LOG_MODE') or 'sync'
+    LOG_BATCH_SIZE = _env_int('LOG_BATCH_SIZE', 256)
+    METRICS_ENABLED = _env_bool('METRICS_ENABLED', True)
+    ADMISSION_MAX_ENROLLMENTS = _env_int('ADMISSION_MAX_ENROLLMENTS', 4)
+    ADMISSION_MAX_ACTIVE = _env_int('ADMISSION_MAX_ACTIVE', 16)
+    ADMISSION_MAX_WAITING = _env_int('ADMISSION_MAX_WAITING', 32)
+    ADMISSION_TIMEOUT = _env_float('ADMISSION_TIMEOUT', 2)
+    ADMISSION_RETRY_AFTER = _env_int('ADMISSION_RETRY_AFTER', 5)
+    WARMUP = _env_bool('WARMUP', True)
+    COMPRESSION_ENABLED = _env_bool('COMPRESSION_ENABLED', True)
+    COMPRESSION_MIN_SIZE = _env_int('COMPRESSION_MIN_SIZE', 500)
+    GZIP_LEVEL = _env_int('GZIP_LEVEL', 6)
+    BROTLI_QUALITY = _env_int('BROTLI_QUALITY', 5)
@@ -0,0 +1,58 @@
+import json, logging, os, threading
+from flask import current_app
+
+logger = logging.getLogger('vqg')
+
+# The sizes attribute that goes with the derivative srcset: images fill the page on
+# narrow screens and are never shown wider than the largest display width
+IMAGE_SIZES = '(max-width: 640px) 100vw, 640px'
+
+# Derivative file names include a hash of their content, so they never change
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+_manifest = {}
+_manifest_mtime = None
+_manifest_lock = threading.Lock()
+
+##########
+#
+#   Return the url and srcset to display an image with, using the derivatives made by
+#   app/make_derivatives.py if there are any, and the original image otherwise
+#
+#   Return values:
+#       image_url: the url of the largest derivative, or of the original image
+#       image_srcset: a srcset listing every derivative by width, or None
+#
+##########
+def get_display_urls(img_path):
+    derivatives = _get_manifest().get(img_path)
+    if not derivatives:
+        return img_path, None
+
+    widths = sorted(derivatives, key=int)
+    image_srcset = ', '.join(f'{derivatives[width]} {width}w' for width in widths)
+    return derivatives[widths[-1]], image_srcset
+
+##########
+#
+#   Load the derivative manifest, reloading it whenever app/make_derivatives.py rewrites it
+#
+##########
+def _get_manifest():
+    global _manifest, _manifest_mtime
+
+    path = os.path.join(current_app.static_folder, 'derivatives', 'manifest.json')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+
+    if not mtime == _manifest_mtime:
+        with _manifest_lock:
+            if not mtime == _manifest_mtime:
+                with open(path) as f:
+                    _manifest = json.load(f)
+                _manifest_mtime = mtime
+                logger.info('_get_manifest loaded derivatives for %s images', len(_manifest))
+
+    return _manifest
@@ -0,0 +1,59 @@
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+##########
+#
+#   Build SQLALCHEMY_ENGINE_OPTIONS for the configured database.  For SQLite,
+#   connections are kept in a queue pool of DB_POOL_SIZE connections (plus up to
+#   DB_MAX_OVERFLOW more under load) instead of opening a new connection for every
+#   request.  Pooled connections are handed between request threads, so SQLite's
+#   same-thread check is turned off.  A DB_POOL_SIZE of 0 opens a connection per request.
+#
+##########
+def get_engine_options(config):
+    uri = config.get('SQLALCHEMY_DATABASE_URI')
+    if not uri or not make_url(uri).get_backend_name() == 'sqlite':
+        return {}
+
+    if config['DB_POOL_SIZE'] > 0:
+        return {'poolclass': QueuePool, 'pool_size': config['DB_POOL_SIZE'],
+                'max_overflow': config['DB_MAX_OVERFLOW'], 'connect_args': {'check_same_thread': False}}
+
+    return {'poolclass': NullPool}
+
+##########
+#
+#   Apply the SQLite connection settings to every new connection of the app's engine:
+#       SQLITE_JOURNAL_MODE: WAL lets readers carry on while a participant's answers are
+#           written, instead of every reader blocking the writer
+#       SQLITE_SYNCHRONOUS: NORMAL only syncs the WAL at checkpoints, which is safe
+#           against application crashes (but not power loss) in WAL mode
+#       SQLITE_BUSY_TIMEOUT: how long, in milliseconds, a connection waits for a lock
+#           before failing with "database is locked"
+#
+#   An empty SQLITE_JOURNAL_MODE or SQLITE_SYNCHRONOUS leaves SQLite's own default in place.
+#
+##########
+def configure_sqlite(config, engine):
+    for name, value, allowed in [('SQLITE_JOURNAL_MODE', config['SQLITE_JOURNAL_MODE'], JOURNAL_MODES), ('SQLITE_SYNCHRONOUS', config['SQLITE_SYNCHRONOUS'], SYNCHRONOUS_MODES)]:
+        if value and not value.upper() in allowed:
+            raise ValueError(f'{name} must be one of {", ".join(allowed)}, not {value}')
+
+    pragmas = [('journal_mode', config['SQLITE_JOURNAL_MODE']), ('synchronous', config['SQLITE_SYNCHRONOUS']), ('busy_timeout', config['SQLITE_BUSY_TIMEOUT'])]
+    pragmas = [(name, value) for name, value in pragmas if value]
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        if not type(dbapi_connection).__module__.startswith('sqlite3'):
+            return
+
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas:
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+    return set_sqlite_pragmas
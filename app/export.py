@@ -0,0 +1,162 @@
+import csv, itertools, json, os, tempfile
+from datetime import datetime
+from sqlalchemy import and_, or_
+from app import db
+from app.models import Annotation, Image, User
+
+# The columns of an export, in order
+EXPORT_COLUMNS = ('annotation_id', 'q_num', 'q_content', 'timestamp', 'image_id', 'img_path', 'prolific_id', 'study_id', 'session_id')
+
+EXPORT_FORMATS = ('csv', 'jsonl', 'parquet')
+
+##########
+#
+#   Stream the annotations, joined with their user and image, in chunks of chunk_size
+#   rows.  Rows are read with a single query and yielded as they arrive rather than
+#   loaded all at once.
+#
+#   With key 'id', only annotations whose id is greater than since are exported, in
+#   id order.  With key 'timestamp', since is a (timestamp, id) pair, and annotations
+#   are exported in timestamp order from just after it, up to until.  An annotation's
+#   timestamp is set before it is committed, so the newest annotations are left for the
+#   next export: one still being committed could otherwise land behind the watermark.
+#
+##########
+def iter_annotation_chunks(key='id', since=None, chunk_size=5000, until=None):
+    query = db.session.query(Annotation.id, Annotation.q_num, Annotation.q_content, Annotation.timestamp, Annotation.image_id,
+                             Image.img_path, User.prolific_id, User.study_id, User.session_id) \
+        .outerjoin(Image, Annotation.image_id == Image.id) \
+        .outerjoin(User, Annotation.user_id == User.id)
+
+    if key == 'id':
+        if since is not None:
+            query = query.filter(Annotation.id > since)
+        query = query.order_by(Annotation.id)
+    else:
+        if since is not None:
+            timestamp, annotation_id = since
+            query = query.filter(or_(Annotation.timestamp > timestamp, and_(Annotation.timestamp == timestamp, Annotation.id > annotation_id)))
+        if until is not None:
+            query = query.filter(or_(Annotation.timestamp == None, Annotation.timestamp <= until))
+        query = query.order_by(Annotation.timestamp, Annotation.id)
+
+    rows = iter(query.yield_per(chunk_size))
+    while True:
+        chunk = list(itertools.islice(rows, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+##########
+#
+#   Export the annotations to path in the given format.  The export is written to a
+#   temporary file that replaces path only once it is complete, so a failed export
+#   never leaves a partial file behind.  A path of '-' writes CSV or JSONL to stdout.
+#
+#   Return values:
+#       n_rows: the number of annotations exported
+#       watermark: the watermark after the last exported annotation, or None if
+#           nothing was exported
+#
+##########
+def export_annotations(path, fmt, key='id', since=None, chunk_size=5000, stdout=None, until=None):
+    writer = {'csv': _write_csv, 'jsonl': _write_jsonl, 'parquet': _write_parquet}[fmt]
+    chunks = _Tracker(iter_annotation_chunks(key, since, chunk_size, until))
+
+    if path == '-':
+        if fmt == 'parquet':
+            raise ValueError('Parquet exports cannot be written to stdout')
+        writer(stdout, chunks)
+    else:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb' if fmt == 'parquet' else 'w', **({} if fmt == 'parquet' else {'newline': '', 'encoding': 'utf-8'})) as f:
+                writer(f, chunks)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    if chunks.last is None:
+        return chunks.n_rows, None
+
+    return chunks.n_rows, {'key': key, 'id': chunks.last[0], 'timestamp': chunks.last[3].isoformat() if chunks.last[3] else None}
+
+##########
+#
+#   Read and write the watermark file that incremental exports pick up from.  The
+#   watermark records the last exported annotation's id and timestamp.
+#
+##########
+def read_watermark(path, key):
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        watermark = json.load(f)
+
+    if not watermark['key'] == key:
+        raise ValueError(f"The watermark in {path} is keyed on {watermark['key']}, not {key}")
+
+    if key == 'id':
+        return watermark['id']
+    return datetime.fromisoformat(watermark['timestamp']), watermark['id']
+
+def write_watermark(path, watermark):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    with os.fdopen(fd, 'w') as f:
+        json.dump(watermark, f)
+    os.replace(tmp_path, path)
+
+##########
+#
+#   Counts the rows passing through to a writer and remembers the last one
+#
+##########
+class _Tracker(object):
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.n_rows = 0
+        self.last = None
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.n_rows += len(chunk)
+            self.last = chunk[-1]
+            yield chunk
+
+def _write_csv(f, chunks):
+    writer = csv.writer(f)
+    writer.writerow(EXPORT_COLUMNS)
+    for chunk in chunks:
+        writer.writerows(chunk)
+
+def _write_jsonl(f, chunks):
+    for chunk in chunks:
+        f.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), default=_json_default) + '\n' for row in chunk)
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+##########
+#
+#   Parquet exports need pyarrow, which is not installed with the application.  Each
+#   chunk is written as its own row group, so memory use stays bounded by chunk_size.
+#
+##########
+def _write_parquet(f, chunks):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ValueError('Parquet exports need pyarrow: pip install pyarrow')
+
+    schema = pa.schema([('annotation_id', pa.int64()), ('q_num', pa.int64()), ('q_content', pa.string()), ('timestamp', pa.timestamp('us')),
+                        ('image_id', pa.int64()), ('img_path', pa.string()), ('prolific_id', pa.string()), ('study_id', pa.string()), ('session_id', pa.string())])
+
+    with pq.ParquetWriter(f, schema) as writer:
+        for chunk in chunks:
+            writer.write_table(pa.Table.from_arrays([pa.array(column, type=field.type) for column, field in zip(zip(*chunk), schema)], schema=schema))
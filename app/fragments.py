@@ -0,0 +1,33 @@
+import threading
+from flask import current_app
+from markupsafe import Markup
+
+_fragments = {}
+_fragments_lock = threading.Lock()
+
+##########
+#
+#   Render a template that is the same for every user once, and serve the cached
+#   copy afterwards.  Fragments are rendered only with the values passed here (and
+#   the jinja globals such as url_for), never with the request context, so nothing
+#   user-specific can end up in the cache.  A fragment is cached once per
+#   combination of values, so only pass values that take a handful of settings.
+#
+#   While templates are auto-reloaded (e.g. in debug mode), fragments are rendered
+#   on every call.
+#
+##########
+def render_fragment(template_name, **context):
+    key = (template_name, tuple(sorted(context.items())))
+    fragment = _fragments.get(key)
+    if fragment is not None:
+        return fragment
+
+    fragment = Markup(current_app.jinja_env.get_template(template_name).render(**context))
+    if not current_app.templates_auto_reload:
+        with _fragments_lock:
+            _fragments[key] = fragment
+    return fragment
+
+def configure_fragments(app):
+    app.jinja_env.globals['fragment'] = render_fragment
@@ -0,0 +1,290 @@
+import json, logging, os, threading, time
+from datetime import datetime
+from flask import current_app, g
+from sqlalchemy import inspect, text
+from app import db
+from app.models import Annotation, Image, SessionPlan, User
+
+logger = logging.getLogger('vqg')
+
+# The User columns that are restored from the journal, besides the ids
+USER_FIELDS = ('study_id', 'session_id', 'progress', 'current_image_id', 'attn_check', 'vision_check', 'prev_survey', 'race', 'gender', 'start_time', 'end_time')
+ANNOTATION_FIELDS = ('user_id', 'image_id', 'q_num', 'q_content', 'q_fingerprint', 'timestamp')
+TIME_FIELDS = ('start_time', 'end_time', 'timestamp')
+
+##########
+#
+#   An append-only journal of participant state transitions, in JSON lines:
+#       enroll: a user was created, with their Prolific parameters and first image
+#       assign: a user moved on to a new image
+#       annotate: a user's annotations of an image
+#       survey: a user's post-survey answers
+#       progress: a user's new progress step
+#
+#   Events are staged on flask.g while a request changes the database, and appended once
+#   the change is committed (see utils._try_commit), so the journal only records
+#   transitions that happened.  Appends are group-committed: a writer thread writes all
+#   of the events that are waiting with a single write and fsync, and each request waits
+#   until its events are on disk.  The file is opened for appending when the journal is
+#   created, so that a JOURNAL_FILE that cannot be written stops the app from starting,
+#   and the workers of a study can share one journal.
+#
+#   The database changes are committed before their events are appended, so a failed or
+#   slow write does not fail the request: it is logged, and a request waits at most
+#   timeout seconds for its events.
+#
+##########
+class Journal(object):
+
+    def __init__(self, path, fsync, timeout):
+        self.path = path
+        self.fsync = fsync
+        self.timeout = timeout
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._condition = threading.Condition()
+        self._pending = []
+        self._appended = 0
+        self._written = 0
+        self._thread = None
+        self._pid = None
+
+    ##########
+    #
+    #   Append lines to the journal, and wait until they have been written
+    #
+    ##########
+    def append(self, lines):
+        deadline = time.monotonic() + self.timeout
+        with self._condition:
+            if self._thread is None or not self._pid == os.getpid() or not self._thread.is_alive():
+                self._start()
+
+            self._pending.extend(lines)
+            self._appended += len(lines)
+            appended = self._appended
+            self._condition.notify_all()
+
+            while self._written < appended:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error('Journal: gave up waiting after %ss for %s events to be written to %s', self.timeout, len(lines), self.path)
+                    return
+                self._condition.wait(remaining)
+
+    # The writer is started in each process that appends, since threads do not survive a fork
+    def _start(self):
+        self._pending, self._appended, self._written = [], 0, 0
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run, name='vqg-journal-writer', daemon=True)
+        self._thread.start()
+
+    # The writer is counted as having written each batch even if the write fails, so that
+    # no request is left waiting for it
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                batch, self._pending = self._pending, []
+
+            try:
+                data = ''.join(batch).encode('utf-8')
+                while data:
+                    data = data[os.write(self._fd, data):]
+                if self.fsync:
+                    os.fsync(self._fd)
+            except Exception:
+                logger.exception('Journal could not write %s events to %s', len(batch), self.path)
+            finally:
+                with self._condition:
+                    self._written += len(batch)
+                    self._condition.notify_all()
+
+##########
+#
+#   Set up the journal if JOURNAL_FILE is set
+#
+##########
+def configure_journal(app):
+    if app.config['JOURNAL_FILE']:
+        try:
+            app.extensions['journal'] = Journal(app.config['JOURNAL_FILE'], app.config['JOURNAL_FSYNC'], app.config['JOURNAL_TIMEOUT'])
+        except OSError as err:
+            raise ValueError(f"JOURNAL_FILE {app.config['JOURNAL_FILE']} cannot be opened for appending: {err}") from err
+
+##########
+#
+#   Stage an event, to be appended to the journal when the request's changes are
+#   committed.  Field values can be model objects that are not flushed yet, which are
+#   written as their primary key once it is known.
+#
+##########
+def record_event(event, **fields):
+    if 'journal' in current_app.extensions:
+        g.setdefault('journal_events', []).append(dict(event=event, time=datetime.utcnow(), **fields))
+
+def commit_events():
+    events = g.pop('journal_events', None)
+    if events:
+        current_app.extensions['journal'].append([json.dumps(_resolve(event), default=_json_default) + '\n' for event in events])
+
+def discard_events():
+    g.pop('journal_events', None)
+
+def _resolve(value):
+    if isinstance(value, dict):
+        return dict((key, _resolve(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return [_resolve(item) for item in value]
+    if isinstance(value, db.Model):
+        return inspect(value).identity[0]
+    return value
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+##########
+#
+#   The users and annotations that a journal adds up to
+#
+##########
+class JournalState(object):
+
+    def __init__(self):
+        self.users = {}
+        self.annotations = {}
+        self.events = 0
+        self.skipped = 0
+
+    def annotation_counts(self):
+        counts = {}
+        for annotation in self.annotations.values():
+            counts[annotation['image_id']] = counts.get(annotation['image_id'], 0) + 1
+        return counts
+
+##########
+#
+#   Replay a journal into a JournalState.  Lines that cannot be parsed, e.g. the last
+#   line of a journal that was being written when the server went down, are skipped
+#   and counted.
+#
+##########
+def read_journal(path):
+    state = JournalState()
+
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            try:
+                event = json.loads(line)
+                _apply(state, event)
+            except (ValueError, KeyError, TypeError):
+                state.skipped += 1
+                continue
+            state.events += 1
+
+    return state
+
+def _apply(state, event):
+    kind = event['event']
+
+    if kind == 'enroll':
+        state.users[event['user']] = {'prolific_id': event['prolific_id'], 'study_id': event['study_id'], 'session_id': event['session_id'],
+                                      'progress': 0, 'current_image_id': event['image_id'], 'start_time': event['start_time']}
+        return
+
+    u = state.users[event['user']]
+    if kind == 'assign':
+        u['current_image_id'] = event['image_id']
+    elif kind == 'annotate':
+        for annotation in event['annotations']:
+            state.annotations[annotation['id']] = dict(annotation, user_id=event['user'], image_id=event['image_id'])
+    elif kind == 'survey':
+        u.update((key, event[key]) for key in ('attn_check', 'vision_check', 'prev_survey', 'race', 'gender', 'end_time'))
+    elif kind == 'progress':
+        u['progress'] = event['progress']
+    else:
+        raise KeyError(kind)
+
+##########
+#
+#   Compare the database with the journal
+#
+#   Return:
+#       differences: a description of each user, annotation and image count that does
+#           not match the journal
+#
+##########
+def verify_journal(state):
+    differences = []
+    conn = db.session.connection()
+
+    db_users = dict((row.id, row) for row in conn.execute(User.__table__.select()))
+    for user_id, u in state.users.items():
+        row = db_users.pop(user_id, None)
+        if row is None:
+            differences.append(f'User {user_id} ({u["prolific_id"]}) is missing from the database')
+            continue
+        differences += _compare(f'User {user_id}', u, row, ('prolific_id',) + USER_FIELDS)
+    differences += [f'User {user_id} ({row.prolific_id}) is not in the journal' for user_id, row in db_users.items()]
+
+    db_annotations = dict((row.id, row) for row in conn.execute(Annotation.__table__.select()))
+    for annotation_id, annotation in state.annotations.items():
+        row = db_annotations.pop(annotation_id, None)
+        if row is None:
+            differences.append(f'Annotation {annotation_id} is missing from the database')
+            continue
+        differences += _compare(f'Annotation {annotation_id}', annotation, row, ANNOTATION_FIELDS)
+    differences += [f'Annotation {annotation_id} is not in the journal' for annotation_id in db_annotations]
+
+    counts = state.annotation_counts()
+    for image_id, annotation_count in conn.execute(db.select(Image.id, Image.annotation_count)):
+        if not annotation_count == counts.get(image_id, 0):
+            differences.append(f'Image {image_id}: annotation_count is {annotation_count} in the database but {counts.get(image_id, 0)} in the journal')
+
+    return differences
+
+def _compare(name, journaled, row, fields):
+    differences = []
+    for field in fields:
+        value = _to_datetime(journaled.get(field)) if field in TIME_FIELDS else journaled.get(field)
+        if not value == getattr(row, field):
+            differences.append(f'{name}: {field} is {getattr(row, field)!r} in the database but {value!r} in the journal')
+    return differences
+
+##########
+#
+#   Replace the users and annotations in the database with the ones in the journal, and
+#   recount each image's annotations, in a single transaction.  Leases and session plans
+#   are not journaled, so they are cleared; participants who are still in the study
+#   reserve their current image again on their next request.  Run this while the app
+#   is stopped.
+#
+#   Return:
+#       n_users, n_annotations: the number of users and annotations restored
+#
+##########
+def rebuild_from_journal(state):
+    users = [dict(dict.fromkeys(USER_FIELDS), id=user_id, **u) for user_id, u in state.users.items()]
+    annotations = [dict(dict((field, annotation[field]) for field in ANNOTATION_FIELDS), id=annotation_id) for annotation_id, annotation in state.annotations.items()]
+    for row in users + annotations:
+        for field in TIME_FIELDS:
+            if field in row:
+                row[field] = _to_datetime(row[field])
+
+    with db.engine.begin() as conn:
+        conn.execute(SessionPlan.__table__.delete())
+        conn.execute(Annotation.__table__.delete())
+        conn.execute(User.__table__.delete())
+        if users:
+            conn.execute(User.__table__.insert(), users)
+        if annotations:
+            conn.execute(Annotation.__table__.insert(), annotations)
+        conn.execute(text('UPDATE image SET reserved_count = 0, '
+                          'annotation_count = (SELECT COUNT(*) FROM annotation WHERE annotation.image_id = image.id)'))
+
+    return len(users), len(annotations)
+
+def _to_datetime(value):
+    return datetime.fromisoformat(value) if value else None
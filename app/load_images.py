@@ -1,38 +1,118 @@
-import pathlib, re, sqlite3
+import concurrent.futures, os, pathlib, re, sqlite3, struct, time
+from datetime import datetime
+
+IMG_ID_RE = re.compile(r'(\d+)\.jpg$')
+
+# JPEG start-of-frame markers, which hold the image dimensions (C4, C8 and CC are other segments)
+SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
 
 ##########
 #
-#   Load the images from the data files into the db's image table.
-#   The assumption is that all three data files are CSV files in the format
-#   used by the VQG data set
+#   Load the images from the image directory into the db's image table.
+#   The directory is scanned once, and all rows are staged in a temporary table
+#   with executemany and upserted from it in a single transaction, so re-running the
+#   loader is safe: existing images keep their annotation counts and exclusion flags,
+#   and only their path (and, with metadata, their dimensions and size) is updated.
+#   The new and changed images are logged in image_change in the same transaction,
+#   so that the running workers' ImageSamplers pick them up.
+#
+#   Return:
+#       n_rows: the number of images loaded
 #
-########## 
-def load_images(db, image_dir):
+##########
+def load_images(db, image_dir, metadata=False, workers=None, batch_size=5000):
+    with os.scandir(image_dir) as entries:
+        img_paths = [entry.path for entry in entries if entry.name.endswith('.jpg')]
+
+    # Reading image headers is I/O bound, so it is spread over a pool of threads; parsing
+    # the file names alone is faster without one
+    if metadata:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            rows = list(executor.map(_scan_image_metadata, img_paths))
+        columns = ['img_path', 'width', 'height', 'byte_size']
+    else:
+        rows = [_scan_image(img_path) for img_path in img_paths]
+        columns = ['img_path']
+
+    # The WHERE clauses keep SQLite from reading ON CONFLICT as part of the SELECT's join
+    changed = ' OR '.join(f'image.{column} IS NOT image_load.{column}' for column in columns)
+    log_sql = ("INSERT INTO image_change (image_id, timestamp) SELECT image_load.id, ? FROM image_load "
+               f"LEFT JOIN image ON image.id = image_load.id WHERE image.id IS NULL OR {changed}")
+    upsert_sql = (f"INSERT INTO image(id, {', '.join(columns)}) SELECT id, {', '.join(columns)} FROM image_load WHERE true "
+                  f"ON CONFLICT(id) DO UPDATE SET {', '.join(f'{column}=excluded.{column}' for column in columns)}")
+
     con = sqlite3.connect(db)
-    cur = con.cursor()
-    
-    for img_path in image_dir.glob('*.jpg'):
-        img_file = str(img_path).index('app/')
-        img_file = str(img_path).partition('app/')[2]
-        m = re.search('(\d+).jpg', img_file)
-        img_id = int(m.group(1))
-        
-        cur.execute("INSERT INTO image(id, img_path) VALUES(?, ?)", (img_id, img_file)) 
+    try:
+        with con:
+            con.execute(f"CREATE TEMP TABLE image_load (id INTEGER PRIMARY KEY, {', '.join(columns)})")
+            for i in range(0, len(rows), batch_size):
+                con.executemany(f"INSERT INTO image_load VALUES({', '.join('?' * (len(columns) + 1))})", rows[i:i + batch_size])
+            con.execute(log_sql, (datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),))
+            con.execute(upsert_sql)
+            con.execute("DROP TABLE image_load")
+    finally:
+        con.close()
+
+    return len(rows)
 
-    
-    con.commit()
-    con.close()
+def _scan_image(img_path):
+    img_file = img_path.partition('app/')[2]
+    img_id = int(IMG_ID_RE.search(img_file).group(1))
+    return img_id, img_file
+
+def _scan_image_metadata(img_path):
+    img_id, img_file = _scan_image(img_path)
+    width, height = _jpeg_dimensions(img_path)
+    return img_id, img_file, width, height, os.path.getsize(img_path)
+
+##########
+#
+#   Read the width and height of a JPEG from its start-of-frame segment, without
+#   decoding the image
+#
+#   Return:
+#       width, height: the image dimensions, or None, None if they could not be found
+#
+##########
+def _jpeg_dimensions(img_path):
+    with open(img_path, 'rb') as f:
+        if not f.read(2) == b'\xff\xd8':
+            return None, None
+
+        while True:
+            marker = f.read(2)
+            if len(marker) < 2 or not marker[0] == 0xFF:
+                return None, None
+
+            # Skip fill bytes between segments
+            while marker[1] == 0xFF:
+                marker = marker[1:] + f.read(1)
+
+            length = f.read(2)
+            if len(length) < 2:
+                return None, None
+
+            if marker[1] in SOF_MARKERS:
+                height, width = struct.unpack('>xHH', f.read(5))
+                return width, height
+
+            f.seek(struct.unpack('>H', length)[0] - 2, os.SEEK_CUR)
 
 
 if __name__ == "__main__":
     import argparse
-    
+
     parser = argparse.ArgumentParser(description='Load image data into database')
     parser.add_argument('--db', type=pathlib.Path, default='app/vqg.db', help='the Sqlite database')
-    parser.add_argument('--image_dir', default='app/static/data_set', type=pathlib.Path, help='CSV file with the image data set')
+    parser.add_argument('--image_dir', default='app/static/data_set', type=pathlib.Path, help='the directory of images to load')
+    parser.add_argument('--metadata', action='store_true', help='also record each image\'s width, height, and size in bytes')
+    parser.add_argument('--workers', default=None, type=int, help='the number of threads used to scan the image directory')
     args = parser.parse_args()
-    
+
     if not args.image_dir.exists():
         raise Exception(f'Invalid image directory path: {args.image_dir}')
-    
-    load_images(args.db, args.image_dir)
\ No newline at end of file
+
+    start = time.perf_counter()
+    n_rows = load_images(args.db, args.image_dir, args.metadata, args.workers)
+    seconds = time.perf_counter() - start
+    print(f'Loaded {n_rows} images in {seconds:.2f}s ({n_rows / max(seconds, 1e-9):.0f} rows/s)')
@@ -0,0 +1,188 @@
+import atexit, copy, json, logging, logging.handlers, os, queue, threading
+from flask import g, has_request_context, request
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Per-request fields that are attached to every record and written out by JSONFormatter
+CONTEXT_FIELDS = ('user_id', 'progress', 'method', 'path')
+
+# The handler and filter that configure_logging last added to the vqg logger
+_installed = []
+
+##########
+#
+#   Set up the vqg logger from the app config:
+#       LOG_FILE: the file that log records are written to
+#       LOG_LEVEL: the lowest level that is logged; calls below it cost only a level check
+#       LOG_FORMAT: 'text' for the original one-line format, 'json' for JSON lines
+#       LOG_MODE: 'sync' writes each record on the request thread, 'queue' hands records
+#           to a background thread that formats and writes them in batches
+#
+#   The logger is shared by every app in the process, so each call replaces the handler
+#   and filter that the last call added, rather than writing each record once more.
+#
+##########
+def configure_logging(app):
+    logger = logging.getLogger('vqg')
+    logger.setLevel(app.config['LOG_LEVEL'])
+
+    while _installed:
+        handler, context_filter = _installed.pop()
+        logger.removeHandler(handler)
+        logger.removeFilter(context_filter)
+        atexit.unregister(handler.close)
+        handler.close()
+
+    formatter = JSONFormatter() if app.config['LOG_FORMAT'] == 'json' else logging.Formatter(TEXT_FORMAT)
+
+    if app.config['LOG_MODE'] == 'queue':
+        handler = DeferredQueueHandler(app.config['LOG_FILE'], app.config['LOG_BATCH_SIZE'])
+        atexit.register(handler.close)
+    else:
+        handler = logging.FileHandler(app.config['LOG_FILE'])
+    handler.setFormatter(formatter)
+
+    context_filter = ContextFilter()
+    logger.addFilter(context_filter)
+    logger.addHandler(handler)
+    _installed.append((handler, context_filter))
+    return logger
+
+##########
+#
+#   Attach the current participant and request to each record.  This runs on the
+#   request thread, since flask.g and the request are not visible from the writer thread.
+#
+##########
+class ContextFilter(logging.Filter):
+
+    def filter(self, record):
+        if has_request_context():
+            record.user_id = g.get('log_user_id')
+            record.progress = g.get('log_progress')
+            record.method = request.method
+            record.path = request.path
+        return True
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': self.formatTime(record), 'logger': record.name, 'level': record.levelname, 'message': record.getMessage()}
+
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc_info'] = record.exc_text
+
+        return json.dumps(entry, default=str)
+
+##########
+#
+#   A QueueHandler that leaves message formatting to the writer thread.  Arguments that
+#   are not plain values are converted to strings here, since the caller may change
+#   them (e.g. form.errors) before the writer gets to the record.
+#
+#   The queue and its writer thread are started in each process that logs, since
+#   threads do not survive a fork: the workers of a pre-forking server each write their
+#   own records to path.  Closing the handler stops this process's writer, once the
+#   records already queued are written.
+#
+##########
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+
+    def __init__(self, path, batch_size):
+        super().__init__(None)
+        self.path = path
+        self.batch_size = batch_size
+        self.writer = None
+        self._pid = None
+
+    # Called with the handler's lock held, which logging re-creates in a forked child
+    def enqueue(self, record):
+        if self.writer is None or not self._pid == os.getpid() or not self.writer.is_alive():
+            self._start()
+        self.queue.put_nowait(record)
+
+    def _start(self):
+        self.queue = queue.SimpleQueue()
+        self.writer = BatchLogWriter(self.queue, self.path, self.formatter, self.batch_size)
+        self.writer.start()
+        self._pid = os.getpid()
+
+    def close(self):
+        if self.writer is not None and self._pid == os.getpid():
+            self.writer.stop()
+            self.writer = None
+        super().close()
+
+    def prepare(self, record):
+        record = copy.copy(record)
+
+        if isinstance(record.args, tuple):
+            record.args = tuple(arg if isinstance(arg, (str, int, float, bool, type(None))) else str(arg) for arg in record.args)
+        elif record.args:
+            record.msg, record.args = record.getMessage(), None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+##########
+#
+#   A background thread that drains the record queue, formats up to batch_size records
+#   at a time, and writes and flushes each batch with a single write
+#
+##########
+class BatchLogWriter(object):
+    _STOP = object()
+
+    def __init__(self, records, path, formatter, batch_size):
+        self.records = records
+        self.path = path
+        self.formatter = formatter
+        self.batch_size = batch_size
+        self._thread = threading.Thread(target=self._run, name='vqg-log-writer', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def is_alive(self):
+        return self._thread.is_alive()
+
+    def stop(self):
+        self.records.put(self._STOP)
+        self._thread.join(timeout=5)
+
+    def _run(self):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            stopping = False
+
+            while not stopping:
+                batch = [self.records.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self.records.get_nowait())
+                    except queue.Empty:
+                        break
+
+                if self._STOP in batch:
+                    stopping = True
+                    batch = [record for record in batch if record is not self._STOP]
+
+                lines = []
+                for record in batch:
+                    try:
+                        lines.append(self.formatter.format(record))
+                    except Exception as err:
+                        lines.append(f'Could not format log record {record.msg!r} with arguments {record.args!r}: {err}')
+
+                if lines:
+                    f.write('\n'.join(lines) + '\n')
+                    f.flush()
@@ -0,0 +1,259 @@
+import bisect, gzip, json, re, sys, time
+
+TEXT_LINE_RE = re.compile(r'(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - \S+ - \w+ - User (\S+?): (.*)')
+USER_MESSAGE_RE = re.compile(r'User (\S+?): (.*)')
+
+# The lines that make up a participant's timeline, by the rest of their "User <id>: " message
+EVENT_PATTERNS = (
+    ('request', re.compile(r'Received request at progress step (-?\d+)$')),
+    ('submit', re.compile(r'Progress step (-?\d+) form validated')),
+    ('rejected', re.compile(r'Form did not validate()')),
+    ('advance', re.compile(r'Advancing progress to (-?\d+)$')),
+    ('advance', re.compile(r'Setting progress to (-1)$')),
+    ('image', re.compile(r'(?:select image|take planned image) (\d+)')),
+    ('page', re.compile(r'(Returning initial script|returning annotation form|returning post-survey|receiving a completion code|will not receive a completion code)')),
+    ('shown', re.compile(r'adding image id (\d+) to form')),
+    ('deferred', re.compile(r'Enrollment deferred()')),
+    ('check', re.compile(r'Checked annotations()')),
+)
+
+# Events that belong to the request that the last "Received request" line started
+REQUEST_EVENTS = ('submit', 'rejected', 'advance', 'image', 'page', 'shown')
+
+# Bucket upper bounds, in seconds, 20 to a decade from 0.1ms to 10 days
+BUCKETS = tuple(10 ** (exponent / 20) for exponent in range(-80, 121))
+
+# Lines are read in this many lines between checks for timelines that have gone idle
+SWEEP_EVERY = 10000
+
+##########
+#
+#   A distribution of durations in fixed logarithmic buckets, so that it takes the same
+#   memory however many durations it holds.  Quantiles are accurate to a bucket
+#   (about 12%).
+#
+##########
+class Distribution(object):
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        rank, cumulative = q * self.count, 0
+        for bound, count in zip(BUCKETS, self.counts):
+            cumulative += count
+            if cumulative >= rank and cumulative > 0:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0, 'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95), 'p99': self.quantile(0.99), 'max': self.max}
+
+##########
+#
+#   Parse vqg.log, in the text or JSON format (see app/log.py), one line at a time, and
+#   follow each participant through the study.  Only the participants who are active
+#   are kept in memory: a participant's timeline is closed once nothing has been logged
+#   for them for idle seconds (or at the end of the log), and then it is summarized
+#   into the distributions, passed to on_timeline, and turned into a replay profile
+#   that is passed to on_profile.  So the memory used depends on how many participants
+#   take part at once, not on the size of the log.
+#
+#   Request latencies are taken from the log: the time from a request's "Received
+#   request" line to its last line.  Text logs do not record the method, so requests
+#   that submitted a form count as POSTs, and the others as GETs.
+#
+##########
+class LogAnalyzer(object):
+
+    def __init__(self, progress_completion, idle=900, on_timeline=None, on_profile=None):
+        self.progress_completion = progress_completion
+        self.idle = idle
+        self.on_timeline = on_timeline
+        self.on_profile = on_profile
+        self.latencies = {}
+        self.dwell_times = {}
+        self.outcomes = {}
+        self.lines = 0
+        self.events = 0
+        self.timelines = 0
+        self.first_time = None
+        self.last_time = None
+        self._active = {}
+        self._time_prefix = None
+        self._time_seconds = None
+
+    def read(self, f):
+        for line in f:
+            self.lines += 1
+            event = self._parse(line)
+            if event:
+                self._add(*event)
+
+            if self.lines % SWEEP_EVERY == 0 and self.first_time is not None:
+                self._close_idle()
+
+    def finish(self):
+        for user_id in list(self._active):
+            self._close(user_id)
+
+    ##########
+    #
+    #   Return the (user_id, time, kind, value, method) of a line, or None if it is not
+    #   part of a participant's timeline
+    #
+    ##########
+    def _parse(self, line):
+        if line.startswith('{'):
+            if '"User ' not in line:
+                return None
+            try:
+                record = json.loads(line)
+                m = USER_MESSAGE_RE.match(record['message'])
+                stamp, method = record['time'], record.get('method')
+            except (ValueError, KeyError, TypeError):
+                return None
+            if not m:
+                return None
+            user_id, message = m.groups()
+            seconds = self._seconds(stamp[:19]) + int(stamp[20:23]) / 1000
+        else:
+            if ' - User ' not in line:
+                return None
+            m = TEXT_LINE_RE.match(line)
+            if not m:
+                return None
+            prefix, millis, user_id, message = m.groups()
+            seconds, method = self._seconds(prefix) + int(millis) / 1000, None
+
+        for kind, pattern in EVENT_PATTERNS:
+            m = pattern.search(message)
+            if m:
+                return user_id, seconds, kind, m.group(1), method
+        return None
+
+    # Log times only change once a second, so the last conversion is kept
+    def _seconds(self, prefix):
+        if not prefix == self._time_prefix:
+            self._time_prefix, self._time_seconds = prefix, time.mktime(time.strptime(prefix, '%Y-%m-%d %H:%M:%S'))
+        return self._time_seconds
+
+    def _add(self, user_id, seconds, kind, value, method):
+        self.events += 1
+        if self.first_time is None:
+            self.first_time = seconds
+        self.last_time = max(seconds, self.last_time or seconds)
+
+        timeline = self._active.get(user_id)
+        if timeline is None:
+            timeline = self._active[user_id] = []
+        timeline.append((seconds, kind, value, method))
+
+    def _close_idle(self):
+        for user_id in [user_id for user_id, timeline in self._active.items() if self.last_time - timeline[-1][0] > self.idle]:
+            self._close(user_id)
+
+    ##########
+    #
+    #   Split a participant's timeline into requests and steps, and record its latencies,
+    #   dwell times and outcome
+    #
+    ##########
+    def _close(self, user_id):
+        events = self._active.pop(user_id)
+        self.timelines += 1
+
+        requests, step_entered, advances = [], {}, []
+        for seconds, kind, value, method in events:
+            if kind == 'request':
+                step = int(value)
+                requests.append({'step': step, 'start': seconds, 'end': seconds, 'method': method})
+                step_entered.setdefault(step, seconds)
+            elif kind in REQUEST_EVENTS and requests:
+                request = requests[-1]
+                request['end'] = seconds
+                if kind in ('submit', 'rejected'):
+                    request['method'] = request['method'] or 'POST'
+                if kind == 'advance':
+                    advances.append((request, int(value)))
+
+        for request in requests:
+            label = f"{request['method'] or 'GET'} step {request['step']}"
+            self.latencies.setdefault(label, Distribution()).add(request['end'] - request['start'])
+
+        for request, _ in advances:
+            self.dwell_times.setdefault(request['step'], Distribution()).add(request['end'] - step_entered[request['step']])
+
+        progress = advances[-1][1] if advances else (requests[-1]['step'] if requests else 0)
+        outcome = 'completed' if progress == self.progress_completion else 'failed' if progress == -1 else 'dropped'
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+        if self.on_timeline:
+            start = events[0][0]
+            self.on_timeline({'user_id': user_id, 'start': time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(start)), 'outcome': outcome,
+                              'events': [[round(seconds - start, 3), kind, value] for seconds, kind, value, _ in events]})
+
+        if self.on_profile and requests and requests[0]['step'] == 0:
+            self.on_profile(self._profile(requests, advances, outcome))
+
+    ##########
+    #
+    #   A participant's replay profile: when they arrived, counted from the start of the
+    #   log, and how long they spent on each step they submitted between being shown
+    #   the step and submitting it.  Rejected submissions count as part of the step.
+    #
+    ##########
+    def _profile(self, requests, advances, outcome):
+        think = []
+        for request, _ in advances:
+            shown = next((r['end'] for r in requests if r['step'] == request['step'] and not r['method'] == 'POST'), request['start'])
+            think.append(round(max(0.0, request['start'] - shown), 3))
+        return {'start': round(requests[0]['start'] - self.first_time, 3), 'think': think, 'outcome': outcome}
+
+    ##########
+    #
+    #   Return the report as a dict of plain values
+    #
+    ##########
+    def report(self):
+        return {'lines': self.lines, 'events': self.events, 'participants': self.timelines, 'outcomes': self.outcomes,
+                'latency': dict((label, self.latencies[label].summary()) for label in sorted(self.latencies, key=_label_order)),
+                'dwell': dict((str(step), self.dwell_times[step].summary()) for step in sorted(self.dwell_times))}
+
+def _label_order(label):
+    method, _, step = label.rpartition(' step ')
+    return (int(step), method)
+
+def format_report(report):
+    lines = [f"{report['lines']} lines, {report['events']} participant events, {report['participants']} participants: "
+             + ', '.join(f'{count} {outcome}' for outcome, count in sorted(report['outcomes'].items()))]
+
+    for title, table, unit, scale in (('Request latency', report['latency'], 'ms', 1000), ('Time on each step', report['dwell'], 's', 1)):
+        lines += ['', title, f'{"":<16}{"count":>8}{"p50 " + unit:>10}{"p95 " + unit:>10}{"p99 " + unit:>10}{"max " + unit:>10}']
+        for label, summary in table.items():
+            label = label if title == 'Request latency' else f'step {label}'
+            lines.append(f'{label:<16}{summary["count"]:>8}' + ''.join(f'{scale * summary[key]:>10.1f}' for key in ('p50', 'p95', 'p99', 'max')))
+
+    return lines
+
+##########
+#
+#   Open a log for reading: '-' for stdin, and .gz files are decompressed as they are read
+#
+##########
+def open_log(path):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8', errors='replace')
+    return open(path, encoding='utf-8', errors='replace')
@@ -0,0 +1,94 @@
+import concurrent.futures, functools, hashlib, io, json, os, pathlib, tempfile, time
+
+# The widths, in pixels, at which images are displayed on the annotation page
+DISPLAY_WIDTHS = (320, 640)
+
+##########
+#
+#   Resize and re-encode one image at each display width.  Images are never scaled up,
+#   so a display width larger than the image produces a single derivative at the
+#   image's own width.  Each derivative's file name includes a hash of its content, so a
+#   file name always refers to the same bytes and can be cached forever.
+#
+#   Return:
+#       img_file: the image path relative to the app directory (as stored in the image table)
+#       derivatives: a dict from derivative width to derivative path relative to the app directory
+#
+##########
+def make_derivatives(img_path, out_dir, widths, quality):
+    from PIL import Image
+
+    img_file = str(img_path).partition('app/')[2]
+    out_file = str(out_dir).partition('app/')[2]
+    derivatives = {}
+
+    with Image.open(img_path) as img:
+        img = img.convert('RGB')
+
+        for width in sorted(set(min(width, img.width) for width in widths)):
+            resized = img if width == img.width else img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+
+            buf = io.BytesIO()
+            resized.save(buf, 'JPEG', quality=quality, optimize=True, progressive=True)
+            data = buf.getvalue()
+
+            name = f'{img_path.stem}.{width}w.{hashlib.sha1(data).hexdigest()[:12]}.jpg'
+            if not (out_dir / name).exists():
+                _write_atomic(out_dir / name, data)
+
+            derivatives[str(width)] = f'{out_file}/{name}'
+
+    return img_file, derivatives
+
+##########
+#
+#   Make derivatives for every image in image_dir that is not already in the manifest,
+#   using a pool of worker processes, and write the manifest that the app reads to
+#   find them
+#
+##########
+def make_all_derivatives(image_dir, out_dir, widths, quality, workers=None, force=False):
+    out_dir.mkdir(parents=True, exist_ok=True)
+    manifest_path = out_dir / 'manifest.json'
+
+    manifest = {}
+    if manifest_path.exists() and not force:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    img_paths = [img_path for img_path in image_dir.glob('*.jpg') if force or not str(img_path).partition('app/')[2] in manifest]
+
+    start = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        make = functools.partial(make_derivatives, out_dir=out_dir, widths=widths, quality=quality)
+        for img_file, derivatives in executor.map(make, img_paths, chunksize=16):
+            manifest[img_file] = derivatives
+
+    _write_atomic(manifest_path, json.dumps(manifest, indent=1, sort_keys=True).encode())
+    return len(img_paths), time.perf_counter() - start
+
+def _write_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+    os.chmod(tmp_path, 0o644)
+    os.replace(tmp_path, path)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Make resized, re-encoded copies of the images for display')
+    parser.add_argument('--image_dir', default='app/static/data_set', type=pathlib.Path, help='the directory of original images')
+    parser.add_argument('--out_dir', default='app/static/derivatives', type=pathlib.Path, help='the directory to write derivatives and their manifest to')
+    parser.add_argument('--widths', default=DISPLAY_WIDTHS, type=int, nargs='+', help='the display widths to make derivatives for')
+    parser.add_argument('--quality', default=80, type=int, help='the JPEG quality of the derivatives')
+    parser.add_argument('--workers', default=None, type=int, help='the number of worker processes (default: one per CPU)')
+    parser.add_argument('--force', action='store_true', help='remake derivatives for images that are already in the manifest')
+    args = parser.parse_args()
+
+    if not args.image_dir.exists():
+        raise Exception(f'Invalid image directory path: {args.image_dir}')
+
+    n_images, seconds = make_all_derivatives(args.image_dir, args.out_dir, args.widths, args.quality, args.workers, args.force)
+    print(f'Made derivatives for {n_images} images in {seconds:.1f}s')
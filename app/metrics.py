@@ -0,0 +1,170 @@
+import bisect, collections, contextlib, threading, time
+from flask import Response, g, has_request_context, request
+from sqlalchemy import event
+from app import db
+
+# Bucket upper bounds, in seconds for durations and in queries for query counts
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+PROMETHEUS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+##########
+#
+#   A Prometheus histogram with one series per combination of label values.  Each
+#   worker process keeps its own histograms, so every worker has to be scraped.
+#
+##########
+class Histogram(object):
+
+    def __init__(self, name, documentation, labelnames, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def expose(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            series = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+
+        for labels, counts, total in series:
+            label_str = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label_str},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{label_str}}} {total}')
+            lines.append(f'{self.name}_count{{{label_str}}} {cumulative}')
+
+        return lines
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+REQUEST_SECONDS = Histogram('vqg_request_duration_seconds', 'Wall time of each request.', ('route', 'method', 'step'), DURATION_BUCKETS)
+SQL_QUERIES = Histogram('vqg_request_sql_queries', 'Number of SQL statements run by each request.', ('route', 'method', 'step'), COUNT_BUCKETS)
+SQL_SECONDS = Histogram('vqg_request_sql_duration_seconds', 'Total time spent running SQL statements in each request.', ('route', 'method', 'step'), DURATION_BUCKETS)
+TEMPLATE_SECONDS = Histogram('vqg_template_render_seconds', 'Time spent rendering each template.', ('route', 'step', 'template'), DURATION_BUCKETS)
+PHASE_SECONDS = Histogram('vqg_phase_duration_seconds', 'Time spent in each phase of a request.', ('route', 'step', 'phase'), DURATION_BUCKETS)
+
+HISTOGRAMS = (REQUEST_SECONDS, SQL_QUERIES, SQL_SECONDS, TEMPLATE_SECONDS, PHASE_SECONDS)
+
+##########
+#
+#   The measurements for one request, kept on flask.g and recorded when the request
+#   is torn down, once its progress step is known
+#
+##########
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.sql_queries = 0
+        self.sql_seconds = 0.0
+        self.templates = []
+        self.phases = collections.defaultdict(float)
+
+##########
+#
+#   Instrument the app if METRICS_ENABLED is set, recording for every request:
+#       the wall time of the request
+#       the number and total duration of its SQL statements, through the events of the
+#           app's engine
+#       the time spent rendering each template
+#       the time spent in each phase marked with timed_phase
+#   all labelled by route and progress step, and serve them in the Prometheus text
+#   format at /metrics.  When METRICS_ENABLED is off, nothing is hooked in and
+#   /metrics does not exist.
+#
+##########
+def configure_metrics(app):
+    if not app.config['METRICS_ENABLED']:
+        return
+
+    @app.before_request
+    def start_request_metrics():
+        if not request.endpoint == 'metrics':
+            g.request_metrics = RequestMetrics()
+
+    @app.teardown_request
+    def record_request_metrics(exc):
+        metrics = g.pop('request_metrics', None)
+        if metrics is None:
+            return
+
+        route, method, step = request.endpoint or 'unknown', request.method, _step()
+        REQUEST_SECONDS.observe((route, method, step), time.perf_counter() - metrics.start)
+        SQL_QUERIES.observe((route, method, step), metrics.sql_queries)
+        SQL_SECONDS.observe((route, method, step), metrics.sql_seconds)
+        for template, seconds in metrics.templates:
+            TEMPLATE_SECONDS.observe((route, step, template), seconds)
+        for phase, seconds in metrics.phases.items():
+            PHASE_SECONDS.observe((route, step, phase), seconds)
+
+    engine = db.get_engine(app)
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def record_query(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        metrics = g.get('request_metrics') if has_request_context() else None
+        if metrics is not None:
+            metrics.sql_queries += 1
+            metrics.sql_seconds += seconds
+
+    class TimedTemplate(app.jinja_env.template_class):
+
+        def render(self, *args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().render(*args, **kwargs)
+            finally:
+                metrics = g.get('request_metrics') if has_request_context() else None
+                if metrics is not None:
+                    metrics.templates.append((self.name, time.perf_counter() - start))
+
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.route('/metrics')
+    def metrics():
+        lines = []
+        for histogram in HISTOGRAMS:
+            lines.extend(histogram.expose())
+        return Response('\n'.join(lines) + '\n', content_type=PROMETHEUS_CONTENT_TYPE)
+
+##########
+#
+#   Time a phase of the current request, e.g. image selection or the commit.  Outside
+#   of an instrumented request this does nothing.
+#
+##########
+@contextlib.contextmanager
+def timed_phase(phase):
+    metrics = g.get('request_metrics') if has_request_context() else None
+    if metrics is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.phases[phase] += time.perf_counter() - start
+
+def _step():
+    step = g.get('log_progress')
+    return '' if step is None else str(step)
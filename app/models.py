@@ -1,9 +1,13 @@
 from datetime import datetime
+from sqlalchemy.ext.hybrid import hybrid_property
 from app import db
 
+# The number of annotations that a user submits for each image
+ANNOTATIONS_PER_IMAGE = 2
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    prolific_id = db.Column(db.String(64))
+    prolific_id = db.Column(db.String(64), index=True, unique=True)
     study_id = db.Column(db.String(64))
     session_id = db.Column(db.String(64))
     progress = db.Column(db.Integer, default=0)
@@ -15,7 +19,10 @@ class User(db.Model):
     start_time = db.Column(db.DateTime, default=datetime.utcnow)
     end_time = db.Column(db.DateTime)
     current_image_id = db.Column(db.Integer, db.ForeignKey('image.id')) 
+    reserved_image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)
+    reservation_expires_at = db.Column(db.DateTime, index=True)
     annotations = db.relationship('Annotation', backref='author', lazy='dynamic')
+    session_plan = db.relationship('SessionPlan', backref='user', lazy='dynamic')
 
     def __repr__(self):
         return '<User {}>'.format(self.id)
@@ -26,9 +33,22 @@ class User(db.Model):
 class Image(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     img_path = db.Column(db.String(256))
-    img_xclude = db.Column(db.Boolean, default=False)
+    img_xclude = db.Column(db.Boolean, default=False, server_default='0', nullable=False)
+    annotation_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    reserved_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    width = db.Column(db.Integer)
+    height = db.Column(db.Integer)
+    byte_size = db.Column(db.Integer)
     annotations = db.relationship('Annotation', backref='image_ref', lazy='dynamic')
 
+    __table_args__ = (db.Index('ix_image_img_xclude_annotation_count', 'img_xclude', 'annotation_count'),)
+
+    # The annotations an image has, plus those it is due from users who are currently
+    # assigned it.  Images are assigned by lowest load.
+    @hybrid_property
+    def load(self):
+        return self.annotation_count + ANNOTATIONS_PER_IMAGE * self.reserved_count
+
     def __repr__(self):
         return '<Image {}>'.format(self.id)    
     
@@ -37,10 +57,60 @@ class Annotation(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     q_num = db.Column(db.Integer)
     q_content = db.Column(db.String(128))
-    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    q_fingerprint = db.Column(db.String(128))
+    timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True)    
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     #image = db.relationship('Image', back_populates='annotations')
+    __table_args__ = (db.Index('ix_annotation_user_id_q_fingerprint', 'user_id', 'q_fingerprint'),)
+
+    def __repr__(self):
+        return '<Annotation {}>'.format(self.q_content)
+
+##########
+#
+#   Prolific IDs handed out by the /get_params route for testing.  Each row reserves 
+#   one ID; AUTOINCREMENT guarantees that an ID is never handed out twice, even to 
+#   concurrent requests in different worker processes.
+#
+##########
+class ProlificIdSequence(db.Model):
+    __table_args__ = {'sqlite_autoincrement': True}
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<ProlificIdSequence {}>'.format(self.id)
+
+##########
+#
+#   A log of the images whose selection state (annotation count or exclusion) has 
+#   changed.  Each worker process applies the changes logged since it last looked to 
+#   its in-memory ImageSampler, instead of reloading every image.
+#
+##########
+class ImageChange(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'))
+    timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<ImageChange {}>'.format(self.image_id)
+
+##########
+#
+#   The images planned for a user's later annotation steps when SESSION_PLAN is on, 
+#   one row per step.  Each row counts as a reservation of its image until the user 
+#   reaches that step, when the reservation passes to the user's lease and the row 
+#   is deleted.
+#
+##########
+class SessionPlan(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    step = db.Column(db.Integer, nullable=False)
+    image_id = db.Column(db.Integer, db.ForeignKey('image.id'), index=True, nullable=False)
+    __table_args__ = (db.UniqueConstraint('user_id', 'step', name='uq_session_plan_user_id_step'),)
 
     def __repr__(self):
-        return '<Annotation {}>'.format(self.q_content)
\ No newline at end of file
+        return '<SessionPlan {} {}>'.format(self.user_id, self.step)
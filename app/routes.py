@@ -1,93 +1,170 @@
 import os, logging
-from flask import flash, redirect, render_template, request, url_for
-from app import app
+from flask import current_app, flash, g, jsonify, redirect, render_template, request, url_for
 from app.forms import InitialScriptForm, AnnotationForm, PostSurvey
-from app.utils import get_progress_completion, get_user_progress, get_url_params, get_image, validate_step, get_unique_prolific_id
+from app.utils import get_participant, get_progress_completion, get_user_progress, get_url_params, get_image, validate_step, get_unique_prolific_id
 from app.nocache import nocache
+from app.admission import admission_control, configure_admission
+from app.assignment import start_lease_sweeper
+from app.metrics import configure_metrics, timed_phase
+from app.compression import configure_compression
+from app.fragments import configure_fragments
+from app.session_token import configure_session_tokens
+from app.journal import configure_journal
+from app.derivatives import IMAGE_SIZES, IMMUTABLE_CACHE_CONTROL
 
-### Set up logging
 logger = logging.getLogger('vqg')
-logger.setLevel(logging.INFO)
-fh = logging.FileHandler('vqg.log')
-fh.setLevel(logging.INFO)
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-fh.setFormatter(formatter)
-logger.addHandler(fh)
 
-@app.route('/', methods=['GET', 'POST'])
+##########
+#
+#   Register the routes with the app, after setting up metrics, response compression, 
+#   cached fragments, admission control, session tokens and the journal
+#
+##########
+def init_app(app):
+    configure_metrics(app)
+    configure_admission(app)
+    configure_compression(app)
+    configure_fragments(app)
+    configure_session_tokens(app)
+    configure_journal(app)
+
+    app.before_first_request(start_background_tasks)
+    app.add_url_rule('/', 'main', main, methods=['GET', 'POST'])
+    app.add_url_rule('/get_params', 'get_params', get_params, methods=['GET'])
+    app.add_url_rule('/validate_annotation', 'validate_annotation', validate_annotation, methods=['POST'])
+    app.after_request(cache_derivatives)
+
+# Background work only starts in processes that serve requests, not in flask commands
+def start_background_tasks():
+    start_lease_sweeper(current_app._get_current_object())
+
 @nocache
+@admission_control
 def main():
 
-    user_id, progress, err_msg = get_user_progress(request)
-    logger.info(f'User {user_id}: Received request at progress step {progress}')
+    with timed_phase('user_lookup'):
+        user_id, progress, err_msg = get_user_progress(request)
+    g.log_user_id, g.log_progress = user_id, progress
+    logger.info('User %s: Received request at progress step %s', user_id, progress)
     if err_msg:
-        logger.error(f'User {user_id}: Error message received when checking progress: {err_msg}')
+        logger.error('User %s: Error message received when checking progress: %s', user_id, err_msg)
         return err_msg, 400
         
     # The participant has completed the task and needs a completion code
     if progress == get_progress_completion():
-        logger.info(f'User {user_id}: User completed the task and is receiving a completion code')
+        logger.info('User %s: User completed the task and is receiving a completion code', user_id)
         title = "Task Completion"
         return render_template('completion.html', title=title, progress=progress, completion_code=os.environ.get('COMPLETION_CODE'), total=get_progress_completion())
     
     # The participant went through the survey but did not successfully complete the task
     # and does not get a completion code
     if progress == -1:
-        logger.info(f'User {user_id}: User failed to complete and will not receive a completion code')
+        logger.info('User %s: User failed to complete and will not receive a completion code', user_id)
         title = "Task Not Complete"
         return render_template('completion.html', title=title, progress=get_progress_completion(), total=get_progress_completion())
     
     # New user
     if progress == 0:
-        logger.info(f'User {user_id}: Returning initial script to user')
+        logger.info('User %s: Returning initial script to user', user_id)
         form = InitialScriptForm()
         title = "Welcome to the VQG (Visual Question Generation) annotation application"
+        page = 'initial'
     
     # The participant has completed the annotation task and must now complete the post-survey
     if progress == get_progress_completion() - 1:
-        logger.info(f'User {user_id}: User completed the annotation task, returning post-survey')
+        logger.info('User %s: User completed the annotation task, returning post-survey', user_id)
         form = PostSurvey()
         title = "Post-Survey"
+        page = 'survey'
         
     # The participant is in the middle of annotation
     elif progress > 0:
-        logger.info(f'User {user_id}: User is at annotation step {progress}, returning annotation form')
+        logger.info('User %s: User is at annotation step %s, returning annotation form', user_id, progress)
         form = AnnotationForm()
         title = "Image Annotation"
+        page = 'annotate'
              
     if request.method == 'POST':
-        if form.validate_on_submit():
-            form_str = []
-            for field in form:
-                form_str.append(f"{field.name}: {field.data}")
-            logger.info(f'User {user_id}: Progress step {progress} form validated: {"; ".join(form_str)}')        
-            err_msg = validate_step(user_id, form)
+        with timed_phase('form_validation'):
+            validated = form.validate_on_submit()
+        
+        if validated:
+            if logger.isEnabledFor(logging.INFO):
+                form_str = []
+                for field in form:
+                    form_str.append(f"{field.name}: {field.data}")
+                logger.info('User %s: Progress step %s form validated: %s', user_id, progress, "; ".join(form_str))        
+            with timed_phase('record_step'):
+                err_msg = validate_step(user_id, form)
         
             if err_msg:
-                logger.error(f'User {user_id}: Error message received when validating progress: {err_msg}')
+                logger.error('User %s: Error message received when validating progress: %s', user_id, err_msg)
                 return err_msg, 400
         
             return redirect(f"{url_for('main')}{get_url_params(request, progress)}")
     
         else:
-            logger.info(f'User {user_id}: Form did not validate.  Form errors: {form.errors}')
+            logger.info('User %s: Form did not validate.  Form errors: %s', user_id, form.errors)
             flash(f'Form errors: {form.errors}')
             
-    image_id, image_url, err_msg = get_image(user_id)
+    with timed_phase('image_lookup'):
+        image_id, image_url, image_srcset, err_msg = get_image(user_id)
         
     if not err_msg is None:
         return err_msg, 400
     
+    # The initial page is followed by the user's first image, so start loading it now
+    preload = progress == 0
+    
     if "image_id" in form.data.keys():
-        logger.info(f'User {user_id}: adding image id {image_id} to form')
+        logger.info('User %s: adding image id %s to form', user_id, image_id)
         form.image_id.data = image_id
         
     form.user_id.data = user_id    
-    return render_template('index.html', title=title, progress=progress, form=form, image_id=image_id, image_url=image_url, total=get_progress_completion())
+    return render_template('index.html', title=title, page=page, progress=progress, form=form, image_id=image_id, image_url=image_url, image_srcset=image_srcset, image_sizes=IMAGE_SIZES, preload=preload, total=get_progress_completion())
 
 # Navigate here to automatically generate an unused Prolific ID 
-@app.route('/get_params', methods=['GET'])
 @nocache
 def get_params():
-    return redirect(f"{url_for('main')}{get_unique_prolific_id()}")
-    
\ No newline at end of file
+    params, err_msg = get_unique_prolific_id()
+    
+    if err_msg:
+        return err_msg, 400
+        
+    return redirect(f"{url_for('main')}{params}")
+
+##########
+#
+#   Check the annotations on the annotation page without submitting it, so that the page
+#   can tell the participant about a rejected question without a round trip through main.
+#   The annotation fields are checked with the same validators as the annotation form,
+#   and their errors are returned as JSON.  The participant is the one named by the
+#   page's Prolific parameters, not the form's user_id, and the form's CSRF token is
+#   checked, so that nobody else can ask about a participant's questions.
+#
+##########
+@nocache
+def validate_annotation():
+    form = AnnotationForm()
+    u = get_participant(request)
+    if u is None or not 0 < u.progress < get_progress_completion() - 1:
+        return jsonify(valid=False, errors={}), 400
+
+    if form.meta.csrf and not form.csrf_token.validate(form):
+        return jsonify(valid=False, errors={}), 400
+    form.user_id.data = u.prolific_id
+
+    fields = [form.annotation1, form.annotation2]
+    with timed_phase('form_validation'):
+        for field in fields:
+            field.validate(form)
+
+    errors = {field.name: [str(error) for error in field.errors] for field in fields if field.errors}
+    logger.info('User %s: Checked annotations, errors: %s', form.user_id.data, errors)
+    return jsonify(valid=not errors, errors=errors)
+
+# Image derivatives have content-hashed file names, so browsers can keep them forever
+def cache_derivatives(response):
+    if response.status_code == 200 and request.path.startswith(url_for('static', filename='derivatives/')):
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
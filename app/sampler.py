@@ -0,0 +1,206 @@
+import bisect, logging, random, threading, time
+from flask import current_app
+from app import db
+from app.models import ANNOTATIONS_PER_IMAGE, Image, ImageChange
+
+logger = logging.getLogger('vqg')
+
+##########
+#
+#   An in-memory index of image ids bucketed by priority, used to pick a random 
+#   image that a user has not already annotated from the highest-priority bucket.
+#
+#   An image's priority is its load (see Image.load): the lower the load, the sooner 
+#   the image is picked.  With a target annotation count, images that already have 
+#   the target number of annotations come after every image that does not, so they 
+#   are only picked again once every other image has reached the target.
+#
+#   Each bucket is a list of image ids plus a map from image id to its position in
+#   that list, so that moving an image between buckets is O(1) (swap with the last
+#   element and pop).  The non-empty levels are kept in a sorted list, which stays
+#   very short because loads only ever change in small steps.
+#
+##########
+class ImageSampler(object):
+
+    # Added to the level of images that have reached the target annotation count
+    TARGET_REACHED = 1 << 30
+
+    def __init__(self, images=(), target=0):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._levels = []
+        self._level = {}
+        self._counts = {}
+        self._position = {}
+        self.target = target
+        self.change_id = 0
+        self.synced_at = time.monotonic()
+
+        for image_id, annotation_count, reserved_count in images:
+            self._insert(image_id, (annotation_count, reserved_count))
+
+    def __len__(self):
+        return len(self._counts)
+
+    ##########
+    #
+    #   Return the (annotation_count, reserved_count) of an image, or None if the image
+    #   is not in the sampler
+    #
+    ##########
+    def counts(self, image_id):
+        return self._counts.get(image_id)
+
+    ##########
+    #
+    #   Return a random image id from the lowest level bucket that still contains an
+    #   image that is not in excluded.  If the user has annotated every image in the
+    #   lowest bucket, fall back to the next bucket up.
+    #
+    #   This never retries blindly: each bucket costs O(k log k), where k is the
+    #   number of excluded images in that bucket, so the time is bounded by the
+    #   size of the user's history rather than by luck.
+    #
+    #   Return:
+    #       image_id: the selected image id, or None if every image is excluded
+    #
+    ##########
+    def sample(self, excluded=()):
+        with self._lock:
+            for level in self._levels:
+                bucket = self._buckets[level]
+                skip = sorted(self._position[image_id] for image_id in excluded if self._level.get(image_id) == level)
+
+                if len(skip) == len(bucket):
+                    continue
+
+                # Pick uniformly among the eligible positions, then shift the pick past
+                # every excluded position that comes before it
+                i = random.randrange(len(bucket) - len(skip))
+                for position in skip:
+                    if position <= i:
+                        i += 1
+                    else:
+                        break
+
+                return bucket[i]
+
+        return None
+
+    ##########
+    #
+    #   Add to the annotation and reservation counts of an image, moving it to its new bucket
+    #
+    ##########
+    def add(self, image_id, annotations=0, reservations=0):
+        with self._lock:
+            if image_id in self._counts:
+                annotation_count, reserved_count = self._counts[image_id]
+                self._remove(image_id)
+                self._insert(image_id, (annotation_count + annotations, max(reserved_count + reservations, 0)))
+
+    ##########
+    #
+    #   Set the (annotation_count, reserved_count) of an image, or take the image out of 
+    #   the sampler if counts is None (e.g. because the image has been excluded)
+    #
+    ##########
+    def set(self, image_id, counts):
+        with self._lock:
+            if image_id in self._counts:
+                self._remove(image_id)
+            if counts is not None:
+                self._insert(image_id, counts)
+
+    def _get_level(self, counts):
+        annotation_count, reserved_count = counts
+        load = annotation_count + ANNOTATIONS_PER_IMAGE * reserved_count
+        if self.target and annotation_count >= self.target:
+            return self.TARGET_REACHED + load
+        return load
+
+    def _insert(self, image_id, counts):
+        level = self._get_level(counts)
+        bucket = self._buckets.get(level)
+        if bucket is None:
+            bucket = self._buckets[level] = []
+            bisect.insort(self._levels, level)
+
+        self._counts[image_id] = counts
+        self._level[image_id] = level
+        self._position[image_id] = len(bucket)
+        bucket.append(image_id)
+
+    def _remove(self, image_id):
+        del self._counts[image_id]
+        level = self._level.pop(image_id)
+        position = self._position.pop(image_id)
+        bucket = self._buckets[level]
+
+        last = bucket.pop()
+        if not last == image_id:
+            bucket[position] = last
+            self._position[last] = position
+
+        if not bucket:
+            del self._buckets[level]
+            self._levels.remove(level)
+
+
+_sampler = None
+_sampler_lock = threading.Lock()
+
+# The number of image ids to look up per query when applying changes
+SYNC_CHUNK_SIZE = 500
+
+##########
+#
+#   Return the process-wide ImageSampler, loading it from the image table the first
+#   time.  Once IMAGE_SAMPLER_SYNC_INTERVAL seconds have passed since the last sync,
+#   the images logged in the image_change table since then (by other worker processes 
+#   or by the exclusion commands) are re-read and moved to their new buckets.  A sampler 
+#   that has not synced for half of IMAGE_CHANGE_RETENTION is reloaded instead, since 
+#   the changes it missed may have been pruned.
+#
+##########
+def get_sampler():
+    global _sampler
+
+    # Reading the image tables must not flush the request's pending writes, which are 
+    # committed (and retried if the database is locked) by utils._try_commit
+    with _sampler_lock, db.session.no_autoflush:
+        since_sync = None if _sampler is None else time.monotonic() - _sampler.synced_at
+        if since_sync is None or since_sync > current_app.config['IMAGE_CHANGE_RETENTION'] / 2:
+            _sampler = load_sampler()
+        elif since_sync > current_app.config['IMAGE_SAMPLER_SYNC_INTERVAL']:
+            sync_sampler(_sampler)
+
+    return _sampler
+
+def load_sampler():
+    start = time.perf_counter()
+
+    # Note the latest change first, so that changes made while loading are applied on the next sync
+    change_id = db.session.query(db.func.max(ImageChange.id)).scalar() or 0
+    images = db.session.query(Image.id, Image.annotation_count, Image.reserved_count).filter(Image.img_xclude == False)
+    sampler = ImageSampler(images, current_app.config['TARGET_ANNOTATIONS'])
+    sampler.change_id = change_id
+
+    logger.info('load_sampler loaded %s images in %.3fs', len(sampler), time.perf_counter() - start)
+    return sampler
+
+def sync_sampler(sampler):
+    changes = db.session.query(ImageChange.id, ImageChange.image_id).filter(ImageChange.id > sampler.change_id).all()
+
+    if changes:
+        image_ids = list(set(image_id for _, image_id in changes))
+        for i in range(0, len(image_ids), SYNC_CHUNK_SIZE):
+            rows = db.session.query(Image.id, Image.annotation_count, Image.reserved_count, Image.img_xclude).filter(Image.id.in_(image_ids[i:i + SYNC_CHUNK_SIZE]))
+            for image_id, annotation_count, reserved_count, img_xclude in rows:
+                sampler.set(image_id, None if img_xclude else (annotation_count, reserved_count))
+
+        sampler.change_id = max(change_id for change_id, _ in changes)
+        logger.info('sync_sampler applied %s changes to %s images', len(changes), len(image_ids))
+
+    sampler.synced_at = time.monotonic()
@@ -0,0 +1,108 @@
+import logging, time
+from flask import current_app, g, request
+from itsdangerous import BadSignature, URLSafeTimedSerializer
+from app.config import DEFAULT_SECRET_KEY
+
+logger = logging.getLogger('vqg')
+
+COOKIE_NAME = 'vqg_session'
+SALT = 'vqg-session-token'
+
+##########
+#
+#   Signed session tokens, so that a participant who reloads a page is answered without
+#   going to the database.  Whenever a request has the participant's User row at hand,
+#   the participant's ids, progress, current image and the expiry of their lease on it
+#   are signed with SECRET_KEY and sent back in a cookie.  A GET with a token that
+#   matches its Prolific parameters is then answered from the token, for at most
+#   SESSION_TOKEN_MAX_AGE seconds and only while the database would not have to renew
+#   the lease anyway.  POSTs, and the completion pages, always go to the database (see
+#   utils.get_user_progress), and a new token is issued with each step.
+#
+#   Anyone can sign tokens with the default SECRET_KEY, so tokens are turned off unless
+#   SECRET_KEY is set.
+#
+##########
+def configure_session_tokens(app):
+    if app.config['SESSION_TOKENS'] and app.secret_key == DEFAULT_SECRET_KEY:
+        logger.warning('SECRET_KEY is not set, so session tokens are turned off')
+        app.config['SESSION_TOKENS'] = False
+
+    if app.config['SESSION_TOKENS']:
+        app.after_request(_set_session_token_cookie)
+
+def _serializer():
+    return URLSafeTimedSerializer(current_app.secret_key, salt=SALT)
+
+##########
+#
+#   Issue a token for this user, to be sent with the response.  The token is read from
+#   the user's attributes as they are now, so issue it before committing, which would
+#   expire them.  It is only sent if the request succeeds.
+#
+#   Arguments:
+#       u: the user
+#       image_path: the path of the user's current image
+#       lease_expires: when the user's lease on their image is due, as a unix time; 0 if
+#           it has to be renewed, or None if the user holds no lease at their step
+#
+##########
+def issue_session_token(u, image_path, lease_expires):
+    if not current_app.config['SESSION_TOKENS']:
+        return
+
+    g.issued_session_token = {
+        'user_id': u.prolific_id,
+        'study_id': u.study_id,
+        'session_id': u.session_id,
+        'progress': u.progress,
+        'image_id': u.current_image_id,
+        'image_path': image_path,
+        'lease_expires': lease_expires,
+    }
+
+def _set_session_token_cookie(response):
+    token = g.get('issued_session_token')
+    if token and response.status_code < 400:
+        response.set_cookie(COOKIE_NAME, _serializer().dumps(token), max_age=current_app.config['SESSION_TOKEN_MAX_AGE'],
+                            secure=request.is_secure, httponly=True, samesite='Lax')
+    return response
+
+##########
+#
+#   Return the token sent with this request if it can stand in for the database, or None
+#
+#   A token is only used if its signature is valid, it is no older than
+#   SESSION_TOKEN_MAX_AGE, it was issued for the Prolific parameters of this request,
+#   and the user's lease on their image is not due for renewal.
+#
+##########
+def get_session_token():
+    if 'session_token' not in g:
+        g.session_token = _read_session_token()
+    return g.session_token
+
+# Stop using this request's token, e.g. because it no longer matches the database
+def discard_session_token():
+    g.session_token = None
+
+def _read_session_token():
+    if not current_app.config['SESSION_TOKENS'] or not request.method == 'GET':
+        return None
+
+    cookie = request.cookies.get(COOKIE_NAME)
+    if not cookie:
+        return None
+
+    try:
+        token = _serializer().loads(cookie, max_age=current_app.config['SESSION_TOKEN_MAX_AGE'])
+    except BadSignature:
+        return None
+
+    if not (token.get('user_id'), token.get('study_id'), token.get('session_id')) == (request.args.get('PROLIFIC_PID'), request.args.get('STUDY_ID'), request.args.get('SESSION_ID')):
+        return None
+
+    if token.get('lease_expires') is not None and token['lease_expires'] - time.time() <= current_app.config['IMAGE_LEASE_SECONDS'] / 2:
+        return None
+
+    return token
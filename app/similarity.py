@@ -0,0 +1,196 @@
+import csv, logging, os, pickle, random, tempfile, threading, time, zlib
+from flask import current_app
+from app import db
+from app.models import Annotation
+
+logger = logging.getLogger('vqg')
+
+# Bump this whenever the index layout or hashing changes so that stale files on disk are rebuilt
+INDEX_VERSION = 1
+
+SHINGLE_SIZE = 4
+NUM_PERM = 32
+BANDS = 8
+ROWS = NUM_PERM // BANDS
+
+# The MinHash permutations (odd multiplier and offset, modulo 2**32) are fixed so that an 
+# index written by one process is valid in another
+_MASK = (1 << 32) - 1
+_rng = random.Random(467)
+_PERMUTATIONS = [(_rng.getrandbits(32) | 1, _rng.getrandbits(32)) for _ in range(NUM_PERM)]
+
+##########
+#
+#   A MinHash/LSH index over question fingerprints (lowercased, letters only, as produced
+#   by utils._lcase_and_remove_whitespace), used to find near-copies of the control
+#   questions in static/all_qs.csv and of previously submitted annotations.
+#
+#   Each question is split into character shingles, and its MinHash signature is cut
+#   into BANDS bands of ROWS values.  Questions that share any band are candidates, and
+#   candidates are confirmed with the exact Jaccard similarity of their shingle sets.
+#
+##########
+class QuestionIndex(object):
+
+    def __init__(self, corpus_stamp=None):
+        self.corpus_stamp = corpus_stamp
+        self.watermark = 0
+        self.saved_watermark = None
+        self.synced_at = 0
+        self._shingles = {}
+        self._bands = [{} for _ in range(BANDS)]
+
+    def __len__(self):
+        return len(self._shingles)
+
+    ##########
+    #
+    #   Add a question fingerprint to the index under key (e.g. 'all_qs.csv:c12' for a
+    #   control question or 'annotation:345' for an annotation).  Keys that are already 
+    #   indexed are ignored.
+    #
+    ##########
+    def add(self, key, fingerprint):
+        shingles = _shingle(fingerprint)
+        if key in self._shingles or not shingles:
+            return
+
+        self._shingles[key] = shingles
+        for band, band_key in zip(self._bands, _band_keys(shingles)):
+            band.setdefault(band_key, []).append(key)
+
+    ##########
+    #
+    #   Return the key of the most similar indexed question whose Jaccard similarity to
+    #   fingerprint is at least threshold, or None if there is no such question
+    #
+    ##########
+    def find_similar(self, fingerprint, threshold):
+        shingles = _shingle(fingerprint)
+        if not shingles:
+            return None
+
+        candidates = set()
+        for band, band_key in zip(self._bands, _band_keys(shingles)):
+            candidates.update(band.get(band_key, ()))
+
+        best_key, best_similarity = None, threshold
+        for key in candidates:
+            other = self._shingles[key]
+            similarity = len(shingles & other) / len(shingles | other)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+
+        return best_key
+
+def _shingle(fingerprint):
+    if not fingerprint:
+        return frozenset()
+    if len(fingerprint) <= SHINGLE_SIZE:
+        return frozenset([zlib.crc32(fingerprint.encode())])
+    return frozenset(zlib.crc32(fingerprint[i:i + SHINGLE_SIZE].encode()) for i in range(len(fingerprint) - SHINGLE_SIZE + 1))
+
+def _band_keys(shingles):
+    signature = [min([(a * h + b) & _MASK for h in shingles]) for a, b in _PERMUTATIONS]
+    return [tuple(signature[i:i + ROWS]) for i in range(0, NUM_PERM, ROWS)]
+
+
+_index = None
+_index_lock = threading.Lock()
+
+##########
+#
+#   Return the process-wide QuestionIndex.  The first call loads the index from
+#   QUESTION_INDEX_PATH (or builds and saves it if the file is missing or stale), and
+#   any call made more than QUESTION_INDEX_SYNC_INTERVAL seconds after the last sync
+#   adds the annotations that have been inserted since then.
+#
+##########
+def get_question_index():
+    global _index
+
+    with _index_lock:
+        if _index is None:
+            _index = load_question_index()
+
+        if time.monotonic() - _index.synced_at > current_app.config['QUESTION_INDEX_SYNC_INTERVAL']:
+            _sync(_index)
+
+    return _index
+
+##########
+#
+#   Add newly inserted annotations to the process-wide QuestionIndex right away
+#
+##########
+def sync_question_index():
+    with _index_lock:
+        if _index is not None:
+            _sync(_index)
+
+def load_question_index():
+    path = current_app.config['QUESTION_INDEX_PATH']
+    corpus_path = os.path.join(current_app.static_folder, 'all_qs.csv')
+    corpus_stamp = (INDEX_VERSION, _file_checksum(corpus_path))
+
+    try:
+        with open(path, 'rb') as f:
+            index = pickle.load(f)
+        if index.corpus_stamp == corpus_stamp:
+            index.synced_at = 0
+            logger.info('load_question_index loaded %s questions from %s', len(index), path)
+            return index
+        logger.info('load_question_index found a stale index at %s, rebuilding', path)
+    except FileNotFoundError:
+        logger.info('load_question_index found no index at %s, building', path)
+    except Exception as err:
+        logger.error('load_question_index could not read %s, rebuilding: %s', path, err)
+
+    start = time.perf_counter()
+    index = QuestionIndex(corpus_stamp)
+    _add_corpus(index, corpus_path)
+    _sync(index)
+    save_question_index(index, path)
+    logger.info('load_question_index built an index of %s questions in %.3fs', len(index), time.perf_counter() - start)
+    return index
+
+##########
+#
+#   Write the index to path atomically, so that a worker never reads a partial file
+#
+##########
+def save_question_index(index, path):
+    index.saved_watermark = index.watermark
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+    except Exception as err:
+        os.remove(tmp_path)
+        logger.error('save_question_index could not write %s: %s', path, err)
+
+def _add_corpus(index, corpus_path):
+    from app.utils import _lcase_and_remove_whitespace
+
+    with open(corpus_path, newline='', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            index.add(f"all_qs.csv:{row['id']}", _lcase_and_remove_whitespace(row['q_content']))
+
+def _sync(index):
+    rows = db.session.query(Annotation.id, Annotation.q_fingerprint).filter(Annotation.id > index.watermark).order_by(Annotation.id).all()
+
+    for annotation_id, fingerprint in rows:
+        index.add(f'annotation:{annotation_id}', fingerprint)
+        index.watermark = annotation_id
+
+    index.synced_at = time.monotonic()
+
+    # Save once enough new annotations have accumulated that catching up from the
+    # database on the next startup would be slow
+    if index.saved_watermark is not None and index.watermark - index.saved_watermark >= current_app.config['QUESTION_INDEX_SAVE_EVERY']:
+        save_question_index(index, current_app.config['QUESTION_INDEX_PATH'])
+
+def _file_checksum(path):
+    with open(path, 'rb') as f:
+        return zlib.crc32(f.read())
@@ -0,0 +1,59 @@
+import contextlib, logging, time
+from sqlalchemy.exc import OperationalError
+from app import db
+
+logger = logging.getLogger('vqg')
+
+##########
+#
+#   Times the phases of create_app.  The timings are logged once the app is built,
+#   and kept in app.extensions['startup_seconds'].
+#
+##########
+class StartupTimer(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = time.perf_counter() - start
+
+    def report(self, app):
+        total = time.perf_counter() - self.start
+        app.extensions['startup_seconds'] = dict(self.phases, total=total)
+        logger.info('create_app: started in %.3fs (%s)', total, ', '.join(f'{name} {seconds:.3f}s' for name, seconds in self.phases.items()))
+
+##########
+#
+#   Load the caches that image selection and form validation rely on: the
+#   ImageSampler (reading the image counts through their indexes), the near-duplicate
+#   QuestionIndex and the derivative manifest.  A database that has not been set up
+#   or migrated yet, e.g. when running flask db upgrade, just skips the warmup; the
+#   caches are then loaded by the first requests instead.
+#
+#   The pooled connections are closed afterwards, so that none of them is shared by
+#   the worker processes of a server that forks after loading the app.
+#
+##########
+def warm_up(app):
+    from app.derivatives import _get_manifest
+    from app.sampler import get_sampler
+    from app.similarity import get_question_index
+
+    with app.app_context():
+        try:
+            for name, load in [('image sampler', get_sampler), ('question index', get_question_index), ('derivative manifest', _get_manifest)]:
+                start = time.perf_counter()
+                load()
+                logger.info('warm_up: loaded the %s in %.3fs', name, time.perf_counter() - start)
+        except OperationalError as err:
+            logger.info('warm_up: skipped, the database is not ready: %s', err.orig)
+        finally:
+            db.session.remove()
+            db.engine.dispose()
@@ -1,29 +1,23 @@
-import os, logging, random, re
+import os, logging, random, re, time
+from flask import current_app, g
 from app import db
-from app.models import User, Image, Annotation
-from collections import defaultdict
-from datetime import datetime
+from app.assignment import assign_lease, plan_session, release_image, release_reservation, renew_lease, reserve_image, take_planned_image
+from app.derivatives import get_display_urls
+from app.journal import commit_events, discard_events, record_event
+from app.metrics import timed_phase
+from app.models import ANNOTATIONS_PER_IMAGE, User, Image, ImageChange, Annotation, ProlificIdSequence, SessionPlan
+from app.sampler import get_sampler
+from app.session_token import discard_session_token, get_session_token, issue_session_token
+from app.similarity import get_question_index, sync_question_index
+from datetime import datetime, timezone
+from sqlalchemy import inspect
+from sqlalchemy.exc import OperationalError
 from wtforms.validators import ValidationError, StopValidation
 
 logger = logging.getLogger('vqg')
 
-##########
-# 
-#   A list of all image_ids that is used for image selection.  Only return the 
-#   ids of images with the least number of annotations
-#
-########## 
-def get_image_ids():
-    images_by_count = defaultdict(list)
-    images = [(len(list(image.annotations)), image.id) for image in Image.query.all()]
-    
-    for annotation_count, image_id in images:
-        images_by_count[annotation_count].append(image_id)
-    
-    min_annotations = min(images_by_count.keys())
-    image_ids = images_by_count[min_annotations]
-    logger.info(f'get_image_ids returning image id list with length {len(image_ids)}')
-    return images_by_count[min_annotations]
+# The error returned when every image has been excluded or already shown to the user
+NO_IMAGE_LEFT = 'There are no images left to annotate in this study'
 
 ##########
 #    
@@ -33,6 +27,48 @@ def get_image_ids():
 def get_progress_completion():
     return int(os.environ.get('PROGRESS_COMPLETION'))
     
+##########
+#
+#   Look up a user by Prolific ID, loading each user from the database at most once 
+#   per request.  Users are kept in an identity map on flask.g, so the several 
+#   helpers that handle one request all share the same User object.
+#
+##########
+def _get_user(user_id):
+    users = g.setdefault('users', {})
+    u = users.get(str(user_id))
+    
+    if u is None:
+        u = User.get_user(user_id)
+        if u:
+            users[str(user_id)] = u
+    
+    return u
+
+def _cache_user(u):
+    g.setdefault('users', {})[str(u.prolific_id)] = u
+
+##########
+#
+#   Return the user that the request's Prolific parameters name, or None if one of them 
+#   is missing or they do not match a user
+#
+##########
+def get_participant(request):
+    user_id, study_id, session_id = [request.args.get(arg_name) for arg_name in ['PROLIFIC_PID', 'STUDY_ID', 'SESSION_ID']]
+    u = _get_user(user_id) if user_id else None
+    if u and u.study_id == study_id and u.session_id == session_id:
+        return u
+    return None
+
+##########
+#
+#   Whether a user with this Prolific ID has been created yet
+#
+##########
+def is_enrolled(user_id):
+    return _get_user(user_id) is not None
+    
 ##########
 #
 #   This function does several things:
@@ -53,13 +89,21 @@ def get_user_progress(request):
     arg_dict = dict([(arg_name, request.args.get(arg_name)) for arg_name in ['PROLIFIC_PID', 'STUDY_ID', 'SESSION_ID']])
     err = []
     
+    # A page reload in the middle of the study can be answered from the user's session 
+    # token without going to the database.  The completion pages are always checked 
+    # against the user's row.
+    token = get_session_token()
+    if token and 0 <= token['progress'] < get_progress_completion():
+        return token['user_id'], token['progress'], ""
+    discard_session_token()
+    
     # Make sure that the Prolific parameters are all present
     for arg_name, arg_val in arg_dict.items():
         if not arg_val:
             err.append(f'{arg_name} is required')
     
     # Now check if the user exists and if the study and session ids match up
-    u = User.get_user(arg_dict['PROLIFIC_PID'])
+    u = _get_user(arg_dict['PROLIFIC_PID'])
     
     if u:
         if not u.study_id == arg_dict['STUDY_ID']:
@@ -67,17 +111,83 @@ def get_user_progress(request):
 
         if not u.session_id == arg_dict['SESSION_ID']:
             err.append(f"Session ID mismatch: found {u.session_id} in db but passed {arg_dict['SESSION_ID']}")        
+        
+        # Keep the lease on the image while the user is still working on it
+        if not err:
+            renewed = 0 <= u.progress <= get_progress_completion() - 2 and renew_lease(u)
+            _issue_session_token(u)
+            if renewed:
+                logger.info('User %s: Renewing lease on image %s', u.prolific_id, u.current_image_id)
+                err_msg = _try_commit()
+                if err_msg:
+                    err.append(err_msg)
     else:
-        u = User(prolific_id=arg_dict['PROLIFIC_PID'], study_id=arg_dict['STUDY_ID'], session_id=arg_dict['SESSION_ID'])
-        u = _select_image(u)
-        db.session.add(u)
-        err_msg = _try_commit()
+        u = User(prolific_id=arg_dict['PROLIFIC_PID'], study_id=arg_dict['STUDY_ID'], session_id=arg_dict['SESSION_ID'], progress=0, start_time=datetime.utcnow())
+        if current_app.config['SESSION_PLAN']:
+            reserved_image_ids, err_msg = _plan_session(u)
+        else:
+            err_msg = _select_image(u)
+            reserved_image_ids = [u.reserved_image_id] if u.reserved_image_id is not None else []
+        
         if err_msg:
             err.append(err_msg)
+        else:
+            db.session.add(u)
+            _cache_user(u)
+            _issue_session_token(u)
+            record_event('enroll', user=u, prolific_id=u.prolific_id, study_id=u.study_id, session_id=u.session_id, image_id=u.current_image_id, start_time=u.start_time)
+            err_msg = _try_commit()
+            if err_msg:
+                _release_images(reserved_image_ids)
+                err.append(err_msg)
         
     err = "" if len(err) == 0 else "; ".join(err)
     return arg_dict['PROLIFIC_PID'], u.progress, err
 
+##########
+#
+#   Issue a session token with the user's state as it is about to be committed, if 
+#   session tokens are on
+#
+##########
+def _issue_session_token(u):
+    if not current_app.config['SESSION_TOKENS']:
+        return
+    
+    image_path, lease_expires = _get_image_path(u.current_image_id), None
+    
+    # The lease is renewed by get_user_progress from the initial page through the last 
+    # annotation step; a user who holds no lease is given one again there
+    if 0 <= u.progress <= get_progress_completion() - 2:
+        lease_expires = 0
+        if u.reserved_image_id is not None and u.reservation_expires_at is not None:
+            lease_expires = u.reservation_expires_at.replace(tzinfo=timezone.utc).timestamp()
+    
+    issue_session_token(u, image_path, lease_expires)
+
+##########
+#
+#   Look up an image's path, querying the database at most once per request, like 
+#   _get_user.  Only the path is kept, so that a commit in between does not expire it, 
+#   and the image is looked up without flushing, so that a failed commit can still 
+#   replay the pending changes.
+#
+#   Return:
+#       img_path: the image's path, or None if there is no such image
+#
+##########
+def _get_image_path(image_id):
+    if image_id is None:
+        return None
+    
+    paths = g.setdefault('image_paths', {})
+    if image_id not in paths:
+        with db.session.no_autoflush:
+            img = Image.query.get(image_id)
+        paths[image_id] = img.img_path if img else None
+    
+    return paths[image_id]
+
 ##########
 #
 #   Return the parameters to append to the redirect url
@@ -89,7 +199,7 @@ def get_url_params(request, progress=None):
 def _get_url_params(user_id, study_id, session_id, progress=None):
     args = f"?PROLIFIC_PID={user_id}&STUDY_ID={study_id}&SESSION_ID={session_id}"
     args = f"{args}&progress={progress}" if progress else args
-    logger.info(f"User {user_id}: returning parameters {args}")
+    logger.info("User %s: returning parameters %s", user_id, args)
     return args
 
 ##########
@@ -98,46 +208,112 @@ def _get_url_params(user_id, study_id, session_id, progress=None):
 #
 #   Return values:
 #       image_id: The id of the image in the COCO data set
-#       image_url: The url from which to load the image
+#       image_url: The url from which to load the image (a resized derivative, if there is one)
+#       image_srcset: The srcset listing the image's derivatives, or None if there are none
 #
 ##########   
 def get_image(user_id):
 
+    # A page reload can be answered from the user's session token
+    token = get_session_token()
+    if token and token['image_path']:
+        image_url, image_srcset = get_display_urls(token['image_path'])
+        return token['image_id'], image_url, image_srcset, None
+
     # Get a list of all images previously annotated by this user
-    u = User.get_user(user_id)
+    u = _get_user(user_id)
     if not u:
         err_msg = f"User {user_id}: User doesn't exist (in utils.get_image)"
         logger.error(err_msg)
-        return None, None, err_msg
+        return None, None, None, err_msg
     
     image_id = u.current_image_id
     
-    img = Image.query.get(image_id)
-    if not img:
+    image_path = _get_image_path(image_id)
+    if not image_path:
         err_msg = f"Image {image_id}: Image doesn't exist (in utils.get_image)"
         logger.error(err_msg)
-        return None, None, err_msg
+        return None, None, None, err_msg
     
-    return image_id, img.img_path, None
+    image_url, image_srcset = get_display_urls(image_path)
+    return image_id, image_url, image_srcset, None
    
 ##########
 #
-#   Randomly select an image for the annotator to view and make this the user's current image
+#   Randomly select one of the least-loaded images that the annotator has not yet 
+#   seen, reserve it, and make this the user's current image
+#
+#   Return:
+#       err_msg: None if the user was given an image, NO_IMAGE_LEFT if there is none left 
+#           to give, or an error message if the reservation could not be committed
 #
 ##########   
 def _select_image(u):
     
-    # Get a list of all images that this user has annotated      
-    annotated_images = set([annotation.image_id for annotation in u.annotations])
+    # Get a list of all images that this user has annotated, or has planned for later 
+    # steps.  The annotations being recorded are left for _try_commit to write (and 
+    # retry), so the current image, which they are for, is added explicitly
+    with db.session.no_autoflush:
+        annotated_images = set([annotation.image_id for annotation in u.annotations])
+        if u.id is not None:
+            annotated_images.update(image_id for image_id, in db.session.query(SessionPlan.image_id).filter(SessionPlan.user_id == u.id))
+    if u.current_image_id is not None:
+        annotated_images.add(u.current_image_id)
     
-    # Now randomly select images until we find one that the user has not yet annotated
-    image_id = random.choice(get_image_ids())  
-    while image_id in annotated_images:
-        image_id = random.choice(get_image_ids())     
-    
-    logger.info(f'User {u.id}: select image {image_id}')
-    u.current_image_id = image_id
-    return u
+    try:
+        with timed_phase('image_selection'):
+            image_id = reserve_image(annotated_images)
+    except OperationalError as err:
+        logger.error('User %s: could not reserve an image: %s', u.prolific_id, err)
+        return _commit_error(err)
+    
+    if image_id is None:
+        logger.error('User %s: no image left to select', u.prolific_id)
+        return NO_IMAGE_LEFT
+    
+    logger.info('User %s: select image %s', u.prolific_id, image_id)
+    assign_lease(u, image_id)
+    return None
+
+##########
+#
+#   Plan the images for all of a new user's annotation steps at once (SESSION_PLAN), 
+#   so that each later step only has to look up its planned image
+#
+#   Return:
+#       image_ids: the reserved image ids
+#       err_msg: None if the images were reserved, NO_IMAGE_LEFT if there are none, or 
+#           an error message if the reservations could not be committed
+#
+##########
+def _plan_session(u):
+    try:
+        with timed_phase('image_selection'):
+            image_ids = plan_session(u, get_progress_completion() - 2)
+    except OperationalError as err:
+        logger.error('User %s: could not reserve images: %s', u.prolific_id, err)
+        return [], _commit_error(err)
+    
+    if not image_ids:
+        logger.error('User %s: no image left to select', u.prolific_id)
+        return [], NO_IMAGE_LEFT
+    
+    logger.info('User %s: planned images %s', u.prolific_id, image_ids)
+    return image_ids, None
+
+##########
+#
+#   Release reservations that were never handed to a user.  This only runs once 
+#   something else has failed, whose error is the one returned, so a release that 
+#   fails as well is only logged.
+#
+##########
+def _release_images(image_ids):
+    for image_id in image_ids:
+        try:
+            release_image(image_id)
+        except OperationalError as err:
+            logger.error('Image %s: could not release reservation: %s', image_id, err)
 
 ##########
 #
@@ -149,7 +325,7 @@ def _select_image(u):
 ##########     
 def validate_step(user_id, form):
     
-    u = User.get_user(user_id)
+    u = _get_user(user_id)
     err = ""
     
     if not u:
@@ -171,7 +347,9 @@ def validate_step(user_id, form):
         if val_msg and not err:
             u.progress = -1
             db.session.add(u)
-            logger.info(f'User {user_id}: Setting progress to -1')
+            logger.info('User %s: Setting progress to -1', user_id)
+            _issue_session_token(u)
+            record_event('progress', user=u, progress=u.progress)
             return _try_commit()
             
     # The user is annotating, record the annotations in the Annotations table.  There is
@@ -181,8 +359,10 @@ def validate_step(user_id, form):
     
     if not err:
         u.progress = u.progress + 1
-        logger.info(f'User {user_id}: Advancing progress to {u.progress}')
+        logger.info('User %s: Advancing progress to %s', user_id, u.progress)
         db.session.add(u)
+        _issue_session_token(u)
+        record_event('progress', user=u, progress=u.progress)
         err = _try_commit()
     
     return err
@@ -202,7 +382,7 @@ def _validate_post_survey(user_id, form):
     vision_q = form.vision_q.data
     attention_check = form.attention_check.data
     prev_survey = form.prev_survey.data
-    logger.info(f'User {user_id}: Survey question answers: {vision_q}; {attention_check}; {prev_survey}')  
+    logger.info('User %s: Survey question answers: %s; %s; %s', user_id, vision_q, attention_check, prev_survey)  
     #post_qs = [form.post_q1.data, form.post_q2.data, form.post_q3.data, form.post_q4.data, form.post_q5.data]
     #logger.info(f'User {user_id}: Survey question answers: {vision_q}; {post_qs}')   
  
@@ -210,12 +390,12 @@ def _validate_post_survey(user_id, form):
     # Validate that the user answered the vision question correctly
     if vision_q == 'False':
         err.append(f"User {user_id} excluded from this study due to vision impairment.")
-        logger.info(f"User {user_id} excluded from this study due to vision impairment.")
+        logger.info("User %s excluded from this study due to vision impairment.", user_id)
 
     # Validate that the user answered the attention check correctly
     if attention_check == 'False':
         err.append(f"User {user_id} excluded from this study due to failed attention check.")
-        logger.info(f"User {user_id} excluded from this study due to failed attention check.") 
+        logger.info("User %s excluded from this study due to failed attention check.", user_id) 
         
     """
     # Validate that the user answered the attention check questions correctly
@@ -228,7 +408,7 @@ def _validate_post_survey(user_id, form):
     """
     
     # Add the new information to the database
-    u = User.get_user(user_id)
+    u = _get_user(user_id)
     
     if not u:
         commit_err = "Invalid user"
@@ -241,6 +421,7 @@ def _validate_post_survey(user_id, form):
         u.race = _get_demographic(form.race_q.data, form.race_q_other.data)
         u.gender = _get_demographic(form.gender_q.data, form.gender_q_other.data)
         db.session.add(u)
+        record_event('survey', user=u, attn_check=u.attn_check, vision_check=u.vision_check, prev_survey=u.prev_survey, race=u.race, gender=u.gender, end_time=u.end_time)
         commit_err = _try_commit()
     
     val_msg = ";".join(err) if len(err) > 0 else None
@@ -273,53 +454,163 @@ def _get_demographic(checkbox_data, other_data):
 ########## 
 def _record_annotations(user_id, form):
 
-    u = User.get_user(user_id)
+    u = _get_user(user_id)
     if not u:
         err_msg = f"User {user_id}: User doesn't exist (in utils._record_annotations)"
         logger.error(err_msg)
         return err_msg
         
-    a1 = Annotation(q_num=1, q_content=form.annotation1.data, image_id=form.image_id.data, user_id=u.id)
-    a2 = Annotation(q_num=2, q_content=form.annotation2.data, image_id=form.image_id.data, user_id=u.id)
-    #a3 = Annotation(q_num=3, q_content=form.annotation3.data, image_id=form.image_id.data, user_id=u.id)
+    image = Image.query.get(form.image_id.data)
+    if not image:
+        err_msg = f"Image {form.image_id.data}: Image doesn't exist (in utils._record_annotations)"
+        logger.error(err_msg)
+        return err_msg
+
+    now = datetime.utcnow()
+    a1 = Annotation(q_num=1, q_content=form.annotation1.data, q_fingerprint=_lcase_and_remove_whitespace(form.annotation1.data), image_id=form.image_id.data, user_id=u.id, timestamp=now)
+    a2 = Annotation(q_num=2, q_content=form.annotation2.data, q_fingerprint=_lcase_and_remove_whitespace(form.annotation2.data), image_id=form.image_id.data, user_id=u.id, timestamp=now)
+    #a3 = Annotation(q_num=3, q_content=form.annotation3.data, q_fingerprint=_lcase_and_remove_whitespace(form.annotation3.data), image_id=form.image_id.data, user_id=u.id)
     
     db.session.add(a1)
     db.session.add(a2)
     #db.session.add(a3)
+    record_event('annotate', user=u, image_id=image.id, annotations=[
+        {'id': a, 'q_num': a.q_num, 'q_content': a.q_content, 'q_fingerprint': a.q_fingerprint, 'timestamp': a.timestamp} for a in (a1, a2)])
+    
+    # Keep the image's annotation count in step with the annotations, in the same transaction,
+    # and release the user's reservation on it
+    image.annotation_count = Image.annotation_count + ANNOTATIONS_PER_IMAGE
+    db.session.add(ImageChange(image_id=image.id))
+    image_id, released_image_id = image.id, u.reserved_image_id
+    get_sampler().add(image_id, annotations=ANNOTATIONS_PER_IMAGE)
+    release_reservation(u, image)
+    
+    # Move on to the next image, unless this was the last annotation step: the image 
+    # planned for the next step if there is one, which is already reserved, or else a 
+    # newly reserved image.  The user keeps the annotated image as the current image 
+    # until the end of the task.
+    reserved_image_id, err_msg = None, None
+    if u.progress < get_progress_completion() - 2:
+        if not take_planned_image(u, u.progress + 1):
+            err_msg = _select_image(u)
+            reserved_image_id = u.reserved_image_id
+        record_event('assign', user=u, image_id=u.current_image_id)
+    
+    if err_msg:
+        db.session.rollback()
+        discard_events()
+    else:
+        db.session.add(u) 
+        err_msg = _try_commit()
     
-    u = _select_image(u)
-    db.session.add(u) 
-    return _try_commit()
+    # The sampler counted annotations, and a released reservation, that never made it 
+    # into the database, so take them back out
+    if err_msg:
+        if reserved_image_id is not None:
+            _release_images([reserved_image_id])
+        get_sampler().add(image_id, annotations=-ANNOTATIONS_PER_IMAGE)
+        if released_image_id is not None:
+            get_sampler().add(released_image_id, reservations=1)
+    else:
+        sync_question_index()
+    
+    return err_msg
 
 ##########
 #
-#   Try to commit changes to the database, log an error if it occurs
+#   Try to commit changes to the database, log an error if it occurs.  If the 
+#   database is locked by another writer, the session's changes are replayed and the 
+#   commit retried up to COMMIT_RETRIES times, backing off exponentially (with jitter) 
+#   from COMMIT_RETRY_BACKOFF seconds.  The journal events staged for the changes are 
+#   appended once they are committed.
 #
 #   Return:
 #       err_msg: None if the commit went fine, includes an error message if there was one
 #
 ########## 
 def _try_commit():
-    try:
-        db.session.commit()
-        return None
-    except Exception as err:
-        return f"Error message received when committing database: {err}"
+    retries = current_app.config['COMMIT_RETRIES']
+    
+    for attempt in range(retries + 1):
+        changes = _get_pending_changes()
+        try:
+            with timed_phase('commit'):
+                db.session.commit()
+            with timed_phase('journal'):
+                commit_events()
+            return None
+        except OperationalError as err:
+            db.session.rollback()
+            if attempt == retries or not 'database is locked' in str(err):
+                discard_events()
+                return _commit_error(err)
+            
+            delay = current_app.config['COMMIT_RETRY_BACKOFF'] * 2 ** attempt * random.uniform(0.5, 1.5)
+            logger.warning('_try_commit: database is locked, retrying in %.3fs (attempt %s of %s)', delay, attempt + 1, retries)
+            time.sleep(delay)
+            _replay_pending_changes(changes)
+        except Exception as err:
+            db.session.rollback()
+            discard_events()
+            return _commit_error(err)
+
+def _commit_error(err):
+    return f"Error message received when committing database: {err}"
+
+##########
+#
+#   A rollback expunges the session's new objects, expires its changed ones and 
+#   restores its deleted ones, so record them before each commit attempt in order to 
+#   replay them before the next.  Primary keys that were only assigned by the failed 
+#   flush are dropped on replay.
+#
+########## 
+def _get_pending_changes():
+    new = [(obj, set(inspect(obj).dict)) for obj in db.session.new]
+    dirty = []
+    for obj in db.session.dirty:
+        state = inspect(obj)
+        histories = [(prop.key, state.attrs[prop.key].history) for prop in state.mapper.column_attrs]
+        dirty.append((obj, dict((key, history.added[0]) for key, history in histories if history.added)))
+    return new, dirty, list(db.session.deleted)
+
+def _replay_pending_changes(changes):
+    new, dirty, deleted = changes
+    for obj, keys in new:
+        for column in inspect(obj).mapper.primary_key:
+            if not column.key in keys:
+                setattr(obj, column.key, None)
+        db.session.add(obj)
+    
+    for obj, values in dirty:
+        for key, value in values.items():
+            setattr(obj, key, value)
+        db.session.add(obj)
+    
+    for obj in deleted:
+        db.session.delete(obj)
 
 ##########
 #
-#   Get the smallest positive integer that is not being used as a prolific id in the database
+#   Allocate a Prolific ID that has never been used, with a single insert into the 
+#   ProlificIdSequence table
+#
+#   Return values:
+#       params: the parameters to append to the url for the new ID
+#       err_msg: None if the ID was allocated, an error message otherwise
 #
 ########## 
 def get_unique_prolific_id():
-    pid = 1
-    u = User.get_user(pid)
+    seq = ProlificIdSequence(timestamp=datetime.utcnow())
+    db.session.add(seq)
+    err_msg = _try_commit()
     
-    while u:
-        pid += 1
-        u = User.get_user(pid)
-        
-    return _get_url_params(pid, 444, 555)
+    if err_msg:
+        logger.error('get_unique_prolific_id could not allocate an ID: %s', err_msg)
+        return None, err_msg
+    
+    # The commit expired seq, but its identity still holds the new id without a refresh
+    return _get_url_params(inspect(seq).identity[0], 444, 555), None
 
 ##########
 #
@@ -350,23 +641,41 @@ def validate_annotation(form, field):
         _validation_err(user_id, field, 'The annotations for this image are not unique', f'{other_annotations_orig} - {len(other_annotations)}')
     
     # Now make sure that this annotation does not match other previously submitted annotations
-    u = User.get_user(user_id)
+    u = _get_user(user_id)
     
     if u:
-        prev_annotation_objs = u.annotations
-        other_annotations = [a.q_content for a in prev_annotation_objs]
-        other_annotations = set([_lcase_and_remove_whitespace(item) for item in other_annotations])
-        
-        if annotation in other_annotations:
+        if annotation in _get_previous_fingerprints(form, u):
             _validation_err(user_id, field, 'This annotation matches a previous annotation from another image')          
+        
+        # Finally make sure that this annotation is not a near-copy of a control question or any other annotation
+        elif current_app.config['NEAR_DUPLICATE_THRESHOLD'] > 0:
+            match = get_question_index().find_similar(annotation, current_app.config['NEAR_DUPLICATE_THRESHOLD'])
+            if match:
+                _validation_err(user_id, field, 'This annotation is too similar to an existing question', f'matched question {match}')
     else:
         _validation_err(user_id, field, 'When validating annotations, could not find this user in the database')
 
+##########
+#
+#   Return the fingerprints of the annotations on the form that match one of this user's 
+#   previously submitted annotations.  Both form fields are checked with a single query 
+#   on the indexed (user_id, q_fingerprint) columns, and the result is kept on the form 
+#   so that validating the second field does not query again.
+#
+########## 
+def _get_previous_fingerprints(form, u):
+    if not hasattr(form, 'previous_fingerprints'):
+        fingerprints = set([_lcase_and_remove_whitespace(item) for item in [form.annotation1.data, form.annotation2.data]])
+        matches = db.session.query(Annotation.q_fingerprint).filter(Annotation.user_id == u.id, Annotation.q_fingerprint.in_(fingerprints)).distinct()
+        form.previous_fingerprints = set([fingerprint for fingerprint, in matches])
+    
+    return form.previous_fingerprints
+
 def _lcase_and_remove_whitespace(s):
     s = re.findall("[a-z]+", s.lower())
     return "".join(s)
 
 def _validation_err(user_id, field, validation_msg, supp_logging_msg=""):
-    logger.error(f'User {user_id}: {validation_msg}; {supp_logging_msg}')
+    logger.error('User %s: %s; %s', user_id, validation_msg, supp_logging_msg)
     field.errors += (ValidationError(validation_msg),)
     StopValidation()
\ No newline at end of file
@@ -0,0 +1,98 @@
+import argparse, logging, os, random, sys, tempfile, time
+
+##########
+#
+#   Benchmark image selection against a throwaway SQLite database with synthetic
+#   images.  Compares the indexed get_image_ids() query with a rejection loop (and,
+#   with --legacy, the original scan that counted each image's annotations) against
+#   the in-memory ImageSampler.
+#
+#   Run from the top-level directory:
+#       python3 -m benchmarks.image_selection --images 500 80000
+#
+##########
+def timed(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+def report(label, seconds):
+    print(f'    {label:<48} {seconds * 1e6:>12.1f} us/op')
+
+def seed(db, Image, Annotation, n_images):
+    db.drop_all()
+    db.create_all()
+
+    # Most images are already annotated once; a small minimum bucket is the case
+    # where the original rejection loop struggled
+    rows = [{'id': i, 'img_path': f'static/data_set/COCO_train2014_{i:012d}.jpg', 'annotation_count': 2} for i in range(1, n_images + 1)]
+    for row in rows[:max(n_images // 100, 5)]:
+        row['annotation_count'] = 0
+
+    db.session.execute(Image.__table__.insert(), rows)
+    db.session.execute(Annotation.__table__.insert(), [{'q_num': q, 'q_content': 'q', 'image_id': row['id']} for row in rows if row['annotation_count'] for q in (1, 2)])
+    db.session.commit()
+    return [row['id'] for row in rows if row['annotation_count'] == 0]
+
+# The ids of the included images with the fewest annotations, from the indexed 
+# (img_xclude, annotation_count) columns, as image selection read them before the sampler
+def get_image_ids(db, Image):
+    min_annotations = db.session.query(db.func.min(Image.annotation_count)).filter(Image.img_xclude == False).scalar()
+    return [image_id for image_id, in db.session.query(Image.id).filter(Image.img_xclude == False, Image.annotation_count == min_annotations)]
+
+def legacy_get_image_ids(Image):
+    images_by_count = {}
+    for image in Image.query.all():
+        images_by_count.setdefault(len(list(image.annotations)), []).append(image.id)
+    return images_by_count[min(images_by_count.keys())]
+
+def rejection_select(get_ids, annotated):
+    image_id = random.choice(get_ids())
+    while image_id in annotated:
+        image_id = random.choice(get_ids())
+    return image_id
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image selection')
+    parser.add_argument('--images', type=int, nargs='+', default=[500, 80000], help='the number of images to benchmark with')
+    parser.add_argument('--repeat', type=int, default=200, help='the number of selections to time')
+    parser.add_argument('--legacy', action='store_true', help='also time the original per-image annotation scan (slow)')
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}"
+    os.environ.setdefault('PROGRESS_COMPLETION', '7')
+
+    # Keep vqg.log out of the working tree and out of the timings
+    os.chdir(tmp_dir)
+    from app import create_app, db
+    app = create_app()
+    from app.models import Image, Annotation
+    from app.sampler import load_sampler
+    logging.getLogger('vqg').setLevel(logging.WARNING)
+
+    with app.app_context():
+        for n_images in args.images:
+            min_bucket = seed(db, Image, Annotation, n_images)
+
+            # A user who is about to finish, with a full history drawn from the minimum bucket
+            annotated = set(min_bucket[:4])
+
+            print(f'{n_images} images, {len(min_bucket)} in the minimum bucket, user has annotated {len(annotated)} of them')
+
+            if args.legacy:
+                report('legacy scan + rejection loop', timed(lambda: rejection_select(lambda: legacy_get_image_ids(Image), annotated), max(args.repeat // 100, 1)))
+
+            report('indexed get_image_ids + rejection loop', timed(lambda: rejection_select(lambda: get_image_ids(db, Image), annotated), args.repeat))
+
+            start = time.perf_counter()
+            sampler = load_sampler()
+            report('load_sampler', time.perf_counter() - start)
+
+            report('ImageSampler.sample', timed(lambda: sampler.sample(annotated), args.repeat * 100))
+            report('ImageSampler.sample, whole bucket excluded', timed(lambda: sampler.sample(min_bucket), args.repeat * 100))
+            report('ImageSampler.add', timed(lambda: sampler.add(random.randrange(1, n_images + 1), 2), args.repeat * 100))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,264 @@
+import argparse, collections, concurrent.futures, http.cookiejar, json, logging, os, random, re, statistics, string, sys, tempfile, threading, time, urllib.error, urllib.parse, urllib.request
+
+##########
+#
+#   Load test the study by driving virtual Prolific participants through the whole
+#   state machine: the initial script, every annotation step, the post-survey, and the
+#   completion page.
+#
+#   By default the app runs in this process against a throwaway SQLite database seeded
+#   with synthetic images.  Pass --url to drive a running server instead, and --profile
+#   to replay the arrivals and step times recorded in a log (see flask logs --profile).
+#
+#   Run from the top-level directory:
+#       python3 -m benchmarks.load_test --participants 200 --concurrency 50
+#
+##########
+CSRF_RE = re.compile(r'name="csrf_token"[^>]*value="([^"]*)"')
+IMAGE_ID_RE = re.compile(r'name="image_id"[^>]*value="(\d+)"')
+REFRESH_RE = re.compile(r'http-equiv="refresh" content="(\d+)"')
+
+SURVEY = {'vision_q': 'True', 'race_q': 'a', 'gender_q': 'f', 'prev_survey': 'N', 'attention_check': 'True'}
+
+##########
+#
+#   A participant's HTTP session, either through the Flask test client or through
+#   urllib against a running server.  Both keep cookies, which the CSRF token needs.
+#
+##########
+class InProcessSession(object):
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, data=None):
+        response = self.client.open(path, method=method, data=data)
+        return response.status_code, response.get_data(as_text=True)
+
+class HTTPSession(object):
+
+    class _NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    def __init__(self, base_url):
+        self.base_url = base_url.rstrip('/')
+        self.opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), self._NoRedirect())
+
+    def request(self, method, path, data=None):
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data is not None else None
+        try:
+            with self.opener.open(urllib.request.Request(self.base_url + path, data=body, method=method)) as response:
+                return response.status, response.read().decode()
+        except urllib.error.HTTPError as err:
+            return err.code, err.read().decode()
+
+##########
+#
+#   Collects the latency and outcome of every request, labelled by progress step
+#
+##########
+class Recorder(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.annotated_images = collections.Counter()
+        self.completed = 0
+        self.deferred = 0
+
+    def timed(self, label, session, method, path, data=None, expected=(200,)):
+        start = time.perf_counter()
+        status, body = session.request(method, path, data)
+        latency = time.perf_counter() - start
+
+        with self.lock:
+            self.latencies[label].append(latency)
+            if status not in expected:
+                self.errors[label] += 1
+
+        return status, body
+
+def random_question(rng):
+    words = [''.join(rng.choice(string.ascii_lowercase) for _ in range(rng.randint(3, 8))) for _ in range(6)]
+    return ' '.join(words).capitalize() + '?'
+
+##########
+#
+#   Drive one participant from the initial script to the completion page.  A participant
+#   replayed from a profile arrives at the time recorded in the profile, counted from
+#   started and sped up by speed, takes as long over each step, and leaves the study
+#   where they left it.
+#
+##########
+def run_participant(n, session, recorder, progress_completion, think_time, seed, profile=None, speed=1.0, started=None):
+    rng = random.Random(seed)
+    path = f'/?PROLIFIC_PID=load{n}-{seed}&STUDY_ID=loadstudy&SESSION_ID=loadsession{n}'
+
+    if profile:
+        steps = iter(profile['think'])
+        time.sleep(max(0.0, started + profile['start'] / speed - time.perf_counter()))
+
+    # Return False if the participant leaves before submitting this step
+    def think():
+        if profile:
+            seconds = next(steps, None)
+            if seconds is None:
+                return False
+            time.sleep(seconds / speed)
+        elif think_time:
+            time.sleep(rng.uniform(0, think_time))
+        return True
+
+    def csrf(body):
+        m = CSRF_RE.search(body)
+        return m.group(1) if m else ''
+
+    # The initial script.  While enrollments are deferred, wait as long as the
+    # "please wait" page says before reloading it, like a browser would
+    status, body = recorder.timed('GET step 0', session, 'GET', path, expected=(200, 503))
+    while status == 503 and REFRESH_RE.search(body):
+        with recorder.lock:
+            recorder.deferred += 1
+        time.sleep(int(REFRESH_RE.search(body).group(1)))
+        status, body = recorder.timed('GET step 0', session, 'GET', path, expected=(200, 503))
+    if not status == 200 or not think():
+        return
+    status, _ = recorder.timed('POST step 0', session, 'POST', path, {'csrf_token': csrf(body), 'user_id': f'load{n}-{seed}', 'understand': 'y'}, expected=(302,))
+    if not status == 302:
+        return
+
+    # The annotation steps
+    for step in range(1, progress_completion - 1):
+        status, body = recorder.timed(f'GET step {step}', session, 'GET', path)
+        m = IMAGE_ID_RE.search(body)
+        if not status == 200 or not m or not think():
+            return
+        data = {'csrf_token': csrf(body), 'user_id': f'load{n}-{seed}', 'image_id': m.group(1), 'annotation1': random_question(rng), 'annotation2': random_question(rng)}
+        status, _ = recorder.timed(f'POST step {step}', session, 'POST', path, data, expected=(302,))
+        if not status == 302:
+            return
+        with recorder.lock:
+            recorder.annotated_images[int(m.group(1))] += 1
+
+    # The post-survey
+    step = progress_completion - 1
+    status, body = recorder.timed(f'GET step {step}', session, 'GET', path)
+    if not status == 200 or not think():
+        return
+    status, _ = recorder.timed(f'POST step {step}', session, 'POST', path, dict(SURVEY, csrf_token=csrf(body), user_id=f'load{n}-{seed}'), expected=(302,))
+    if not status == 302:
+        return
+
+    # Completion
+    status, _ = recorder.timed('GET complete', session, 'GET', path)
+    if status == 200:
+        with recorder.lock:
+            recorder.completed += 1
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, int(round(p / 100 * (len(sorted_values) - 1))))]
+
+def report(recorder, n_participants, seconds, image_counts):
+    print(f'{recorder.completed} of {n_participants} participants completed in {seconds:.2f}s')
+    print(f'{"request":<16}{"count":>8}{"errors":>8}{"err %":>8}{"p50 ms":>10}{"p95 ms":>10}{"p99 ms":>10}{"max ms":>10}')
+
+    def step_order(label):
+        method, _, step = label.partition(' ')
+        return (int(step.split()[-1]) if step.split()[-1].isdigit() else 1 << 30, method)
+
+    total, errors = 0, 0
+    for label in sorted(recorder.latencies, key=step_order):
+        latencies = sorted(recorder.latencies[label])
+        total += len(latencies)
+        errors += recorder.errors[label]
+        print(f'{label:<16}{len(latencies):>8}{recorder.errors[label]:>8}{100 * recorder.errors[label] / len(latencies):>8.1f}'
+              f'{1000 * percentile(latencies, 50):>10.1f}{1000 * percentile(latencies, 95):>10.1f}{1000 * percentile(latencies, 99):>10.1f}{1000 * latencies[-1]:>10.1f}')
+    print(f'{total} requests ({total / seconds:.1f}/s), {errors} errors ({100 * errors / max(total, 1):.1f}%)')
+    if recorder.deferred:
+        print(f'{recorder.deferred} enrollments deferred by admission control')
+
+    if image_counts:
+        print(f'image coverage over {len(image_counts)} images: min {min(image_counts)}, max {max(image_counts)}, '
+              f'mean {statistics.mean(image_counts):.2f}, stdev {statistics.pstdev(image_counts):.2f}, '
+              f'{sum(1 for count in image_counts if count == 0)} never annotated')
+
+def setup_in_process_app(args):
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'load_test.db')}"
+    os.environ['PROGRESS_COMPLETION'] = str(args.progress_completion)
+
+    # Keep vqg.log and the question index out of the working tree
+    os.chdir(tmp_dir)
+    from app import create_app, db
+    app = create_app()
+    from app.models import Image
+    from app.sampler import get_sampler
+    from app.similarity import get_question_index
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Image.__table__.insert(), [{'id': i, 'img_path': f'static/data_set/COCO_train2014_{i:012d}.jpg'} for i in range(1, args.images + 1)])
+        db.session.commit()
+
+        # Build the in-memory selection and similarity structures before the clock starts
+        get_sampler()
+        get_question_index()
+
+    logging.getLogger('vqg').setLevel(args.log_level)
+    print(f'Seeded {args.images} synthetic images in {tmp_dir}')
+    return app, db
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the study with simulated Prolific participants')
+    parser.add_argument('--participants', type=int, default=None, help='the number of participants to simulate (default: 100, or one for each participant in --profile)')
+    parser.add_argument('--concurrency', type=int, default=20, help='the number of participants active at once')
+    parser.add_argument('--images', type=int, default=500, help='the number of synthetic images to seed (in-process only)')
+    parser.add_argument('--progress_completion', type=int, default=int(os.environ.get('PROGRESS_COMPLETION') or 7), help='the total number of steps (PROGRESS_COMPLETION)')
+    parser.add_argument('--think_time', type=float, default=0, help='the maximum random pause, in seconds, before each submission')
+    parser.add_argument('--profile', help='replay the participants in this load profile, written by flask logs --profile; with more --participants than the profile has, it is repeated')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay the profile this many times faster')
+    parser.add_argument('--url', help='drive a running server at this url instead of an in-process app')
+    parser.add_argument('--log_level', default='WARNING', help='the vqg log level for the in-process app')
+    parser.add_argument('--seed', type=int, default=None, help='the random seed for participant ids and questions')
+    args = parser.parse_args()
+
+    seed = args.seed if args.seed is not None else random.randrange(1 << 30)
+
+    profiles = None
+    if args.profile:
+        with open(args.profile) as f:
+            profiles = sorted((json.loads(line) for line in f if line.strip()), key=lambda profile: profile['start'])
+        if not profiles:
+            parser.error(f'{args.profile} has no participants')
+    if args.participants is None:
+        args.participants = len(profiles) if profiles else 100
+
+    if args.url:
+        app, db = None, None
+        make_session = lambda: HTTPSession(args.url)
+    else:
+        app, db = setup_in_process_app(args)
+        make_session = lambda: InProcessSession(app)
+
+    recorder = Recorder()
+    start = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        futures = [executor.submit(run_participant, n, make_session(), recorder, args.progress_completion, args.think_time, seed + n,
+                                   profiles[n % len(profiles)] if profiles else None, args.speed, start) for n in range(args.participants)]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+    seconds = time.perf_counter() - start
+
+    if app:
+        from app.models import Image
+        with app.app_context():
+            image_counts = [count for count, in db.session.query(Image.annotation_count).filter(Image.img_xclude == False)]
+    else:
+        image_counts = list(recorder.annotated_images.values())
+
+    report(recorder, args.participants, seconds, image_counts)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,152 @@
+import argparse, json, logging, os, random, subprocess, sys, tempfile, threading, time
+
+##########
+#
+#   Benchmark concurrent writes under each SQLite engine profile.  Writer threads
+#   record annotations the way utils._record_annotations does, committing through
+#   utils._try_commit, while reader threads keep selecting images.  Engine settings are
+#   read when the app is imported, so each profile runs in its own process.
+#
+#   Afterwards the image counts are checked against the annotation rows, to make sure
+#   that retried commits were replayed exactly once.
+#
+#   Run from the top-level directory:
+#       python3 -m benchmarks.sqlite_writes --writers 16 --readers 4
+#
+##########
+PROFILES = {
+    'legacy': {'SQLITE_JOURNAL_MODE': '', 'SQLITE_SYNCHRONOUS': '', 'DB_POOL_SIZE': '0', 'COMMIT_RETRIES': '0'},
+    'wal-no-retry': {'SQLITE_JOURNAL_MODE': 'WAL', 'SQLITE_SYNCHRONOUS': 'NORMAL', 'COMMIT_RETRIES': '0'},
+    'wal': {'SQLITE_JOURNAL_MODE': 'WAL', 'SQLITE_SYNCHRONOUS': 'NORMAL'},
+}
+
+class RetryCounter(logging.Handler):
+
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.retries = 0
+
+    def emit(self, record):
+        if record.getMessage().startswith('_try_commit'):
+            self.retries += 1
+
+def run_profile(args):
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(tmp_dir, 'sqlite_writes.db')}"
+    os.chdir(tmp_dir)
+
+    from app import create_app, db
+    app = create_app()
+    from app.models import Annotation, Image, ImageChange, User
+    from app.utils import _try_commit
+    from benchmarks.image_selection import get_image_ids
+
+    logging.getLogger('vqg').setLevel(logging.WARNING)
+    counter = RetryCounter()
+    logging.getLogger('vqg').addHandler(counter)
+
+    with app.app_context():
+        db.create_all()
+        db.session.execute(Image.__table__.insert(), [{'id': i, 'img_path': f'static/data_set/COCO_train2014_{i:012d}.jpg'} for i in range(1, args.images + 1)])
+        db.session.execute(User.__table__.insert(), [{'id': i, 'prolific_id': f'writer{i}', 'progress': 0} for i in range(1, args.writers + 1)])
+        db.session.commit()
+
+    latencies, failures = [], []
+    lock = threading.Lock()
+    stop = threading.Event()
+
+    def write(n):
+        rng = random.Random(n)
+        for i in range(args.transactions):
+            with app.test_request_context():
+                start = time.perf_counter()
+                try:
+                    u = User.query.get(n)
+                    image = Image.query.get(rng.randint(1, args.images))
+                    for q_num in (1, 2):
+                        db.session.add(Annotation(q_num=q_num, q_content=f'Question {q_num} from writer {n}, number {i}?', image_id=image.id, user_id=n))
+                    image.annotation_count = Image.annotation_count + 2
+                    db.session.add(ImageChange(image_id=image.id))
+                    u.progress = u.progress + 1
+                    err_msg = _try_commit()
+                except Exception as err:
+                    err_msg = str(err)
+                latency = time.perf_counter() - start
+
+            with lock:
+                latencies.append(latency)
+                if err_msg:
+                    failures.append(err_msg)
+
+    def read():
+        while not stop.is_set():
+            with app.test_request_context():
+                try:
+                    get_image_ids(db, Image)
+                except Exception:
+                    pass
+
+    readers = [threading.Thread(target=read) for _ in range(args.readers)]
+    writers = [threading.Thread(target=write, args=(n,)) for n in range(1, args.writers + 1)]
+    for thread in readers:
+        thread.start()
+
+    start = time.perf_counter()
+    for thread in writers:
+        thread.start()
+    for thread in writers:
+        thread.join()
+    seconds = time.perf_counter() - start
+
+    stop.set()
+    for thread in readers:
+        thread.join()
+
+    with app.app_context():
+        n_annotations = db.session.query(db.func.count(Annotation.id)).scalar()
+        annotation_count = db.session.query(db.func.sum(Image.annotation_count)).scalar()
+        progress = db.session.query(db.func.sum(User.progress)).scalar()
+
+    latencies.sort()
+    n_committed = len(latencies) - len(failures)
+    return {
+        'seconds': seconds,
+        'committed': n_committed,
+        'failed': len(failures),
+        'retries': counter.retries,
+        'p50': latencies[len(latencies) // 2],
+        'p99': latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))],
+        'consistent': n_annotations == annotation_count == 2 * n_committed and progress == n_committed,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark concurrent writes under each SQLite engine profile')
+    parser.add_argument('--writers', type=int, default=16, help='the number of writer threads')
+    parser.add_argument('--readers', type=int, default=4, help='the number of reader threads selecting images')
+    parser.add_argument('--transactions', type=int, default=50, help='the number of transactions per writer')
+    parser.add_argument('--images', type=int, default=500, help='the number of synthetic images to seed')
+    parser.add_argument('--busy_timeout', type=int, default=None, help='override SQLITE_BUSY_TIMEOUT (ms) for every profile, to provoke lock errors')
+    parser.add_argument('--profiles', nargs='+', default=list(PROFILES), choices=list(PROFILES), help='the engine profiles to compare')
+    parser.add_argument('--run', choices=list(PROFILES), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    # Run a single profile in this process and hand the results back to the parent
+    if args.run:
+        print(json.dumps(run_profile(args)))
+        return
+
+    print(f'{args.writers} writers x {args.transactions} transactions, {args.readers} readers')
+    for profile in args.profiles:
+        env = dict(os.environ, **PROFILES[profile])
+        if args.busy_timeout is not None:
+            env['SQLITE_BUSY_TIMEOUT'] = str(args.busy_timeout)
+        argv = [sys.executable, '-m', 'benchmarks.sqlite_writes', '--run', profile, '--writers', str(args.writers), '--readers', str(args.readers),
+                '--transactions', str(args.transactions), '--images', str(args.images)]
+        output = subprocess.run(argv, env=env, cwd=os.getcwd(), stdout=subprocess.PIPE, check=True, text=True).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+
+        print(f"    {profile:<14} {result['committed'] / result['seconds']:>8.1f} commits/s  {result['failed']:>5} failed  {result['retries']:>5} retries  "
+              f"p50 {1000 * result['p50']:>7.1f} ms  p99 {1000 * result['p99']:>7.1f} ms  {'consistent' if result['consistent'] else 'INCONSISTENT'}")
+
+if __name__ == "__main__":
+    sys.exit(main())
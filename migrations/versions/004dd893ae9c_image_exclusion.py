@@ -0,0 +1,43 @@
+"""image exclusion
+
+Revision ID: 004dd893ae9c
+Revises: 0cbffd91ce95
+Create Date: 2026-10-18 13:05:37.664190
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '004dd893ae9c'
+down_revision = '0cbffd91ce95'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Images loaded straight into the table have no exclusion flag yet
+    op.execute('UPDATE image SET img_xclude = 0 WHERE img_xclude IS NULL')
+
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.alter_column('img_xclude', existing_type=sa.Boolean(), server_default='0', nullable=False)
+        batch_op.drop_index('ix_image_annotation_count')
+        batch_op.create_index('ix_image_img_xclude_annotation_count', ['img_xclude', 'annotation_count'], unique=False)
+
+    op.create_table('image_change',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('image_id', sa.Integer(), nullable=True),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['image_id'], ['image.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+
+
+def downgrade():
+    op.drop_table('image_change')
+
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_index('ix_image_img_xclude_annotation_count')
+        batch_op.create_index('ix_image_annotation_count', ['annotation_count'], unique=False)
+        batch_op.alter_column('img_xclude', existing_type=sa.Boolean(), server_default=None, nullable=True)
@@ -0,0 +1,36 @@
+"""prolific id sequence
+
+Revision ID: 07afcde70812
+Revises: 1fef6f01dab2
+Create Date: 2026-10-18 11:26:04.771530
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '07afcde70812'
+down_revision = '1fef6f01dab2'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    sequence = op.create_table('prolific_id_sequence',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('timestamp', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sqlite_autoincrement=True
+    )
+
+    # Start the sequence after the numeric IDs that were already handed out by probing
+    # the user table, so that none of them are handed out again
+    conn = op.get_bind()
+    numeric_ids = [int(pid) for pid, in conn.execute(sa.text('SELECT prolific_id FROM user')) if pid and pid.isdigit()]
+    if numeric_ids:
+        op.bulk_insert(sequence, [{'id': max(numeric_ids)}])
+
+
+def downgrade():
+    op.drop_table('prolific_id_sequence')
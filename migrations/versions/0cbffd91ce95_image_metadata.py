@@ -0,0 +1,30 @@
+"""image metadata
+
+Revision ID: 0cbffd91ce95
+Revises: 07afcde70812
+Create Date: 2026-10-18 12:14:51.006382
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0cbffd91ce95'
+down_revision = '07afcde70812'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.add_column(sa.Column('width', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('height', sa.Integer(), nullable=True))
+        batch_op.add_column(sa.Column('byte_size', sa.Integer(), nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_column('byte_size')
+        batch_op.drop_column('height')
+        batch_op.drop_column('width')
@@ -0,0 +1,43 @@
+"""annotation fingerprint
+
+Revision ID: 1fef6f01dab2
+Revises: 8ec795366d1b
+Create Date: 2026-10-18 10:41:53.902114
+
+"""
+from alembic import op
+import re
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '1fef6f01dab2'
+down_revision = '8ec795366d1b'
+branch_labels = None
+depends_on = None
+
+
+# Same normalization as utils._lcase_and_remove_whitespace at the time of this migration
+def _fingerprint(s):
+    return "".join(re.findall("[a-z]+", (s or "").lower()))
+
+
+def upgrade():
+    with op.batch_alter_table('annotation') as batch_op:
+        batch_op.add_column(sa.Column('q_fingerprint', sa.String(length=128), nullable=True))
+
+    # Backfill the fingerprints of existing annotations
+    conn = op.get_bind()
+    annotation = sa.table('annotation', sa.column('id', sa.Integer), sa.column('q_content', sa.String), sa.column('q_fingerprint', sa.String))
+    rows = conn.execute(sa.select(annotation.c.id, annotation.c.q_content)).fetchall()
+    if rows:
+        conn.execute(annotation.update().where(annotation.c.id == sa.bindparam('annotation_id')).values(q_fingerprint=sa.bindparam('fingerprint')),
+                     [{'annotation_id': annotation_id, 'fingerprint': _fingerprint(q_content)} for annotation_id, q_content in rows])
+
+    op.create_index('ix_annotation_user_id_q_fingerprint', 'annotation', ['user_id', 'q_fingerprint'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_annotation_user_id_q_fingerprint', table_name='annotation')
+    with op.batch_alter_table('annotation') as batch_op:
+        batch_op.drop_column('q_fingerprint')
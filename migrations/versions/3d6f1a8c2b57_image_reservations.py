@@ -0,0 +1,43 @@
+"""image reservations
+
+Revision ID: 3d6f1a8c2b57
+Revises: 5b1e7c2d9a40
+Create Date: 2026-10-18 17:26:09.730114
+
+"""
+import os
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3d6f1a8c2b57'
+down_revision = '5b1e7c2d9a40'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.add_column(sa.Column('reserved_count', sa.Integer(), server_default='0', nullable=False))
+
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('reserved_image_id', sa.Integer(), nullable=True))
+        batch_op.create_foreign_key('fk_user_reserved_image_id_image', 'image', ['reserved_image_id'], ['id'])
+
+    # Users who are still annotating hold a reservation on their current image.  Users 
+    # past the last annotation step only keep their last image for display.
+    last_annotation_step = int(os.environ.get('PROGRESS_COMPLETION') or 7) - 2
+    op.execute(sa.text('UPDATE "user" SET reserved_image_id = current_image_id '
+                       'WHERE current_image_id IS NOT NULL AND progress >= 0 AND progress <= :last_annotation_step')
+               .bindparams(last_annotation_step=last_annotation_step))
+    op.execute('UPDATE image SET reserved_count = (SELECT count(*) FROM "user" WHERE "user".reserved_image_id = image.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_constraint('fk_user_reserved_image_id_image', type_='foreignkey')
+        batch_op.drop_column('reserved_image_id')
+
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_column('reserved_count')
@@ -0,0 +1,23 @@
+"""annotation timestamp index
+
+Revision ID: 5b1e7c2d9a40
+Revises: 004dd893ae9c
+Create Date: 2026-10-18 15:02:37.418253
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5b1e7c2d9a40'
+down_revision = '004dd893ae9c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_annotation_timestamp'), 'annotation', ['timestamp'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_annotation_timestamp'), table_name='annotation')
@@ -0,0 +1,36 @@
+"""unique user prolific id
+
+Revision ID: 8ec795366d1b
+Revises: ddd8de33b8ff
+Create Date: 2026-10-18 10:02:17.548213
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8ec795366d1b'
+down_revision = 'ddd8de33b8ff'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Stop before creating the index if users share a prolific id, so that they can be
+    # merged or removed by hand rather than picked between here
+    conn = op.get_bind()
+    duplicates = conn.execute(sa.text('SELECT prolific_id, COUNT(*), GROUP_CONCAT(id) FROM user WHERE prolific_id IS NOT NULL '
+                                      'GROUP BY prolific_id HAVING COUNT(*) > 1 ORDER BY prolific_id')).fetchall()
+    if duplicates:
+        listing = '\n'.join(f'  {prolific_id}: {n_users} users (ids {user_ids})' for prolific_id, n_users, user_ids in duplicates)
+        raise Exception(f'Cannot make user.prolific_id unique: {len(duplicates)} prolific ids are shared by more than one user.  '
+                           f'Merge or delete these users and run the upgrade again:\n{listing}')
+
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.create_index(batch_op.f('ix_user_prolific_id'), ['prolific_id'], unique=True)
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_prolific_id'))
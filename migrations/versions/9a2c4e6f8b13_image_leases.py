@@ -0,0 +1,37 @@
+"""image leases
+
+Revision ID: 9a2c4e6f8b13
+Revises: 3d6f1a8c2b57
+Create Date: 2026-10-18 18:40:52.114907
+
+"""
+import os
+from datetime import datetime, timedelta
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9a2c4e6f8b13'
+down_revision = '3d6f1a8c2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.add_column(sa.Column('reservation_expires_at', sa.DateTime(), nullable=True))
+        batch_op.create_index(batch_op.f('ix_user_reservation_expires_at'), ['reservation_expires_at'], unique=False)
+        batch_op.create_index(batch_op.f('ix_user_reserved_image_id'), ['reserved_image_id'], unique=False)
+
+    # Give every reservation held today a full lease from now
+    expires_at = datetime.utcnow() + timedelta(seconds=int(os.environ.get('IMAGE_LEASE_SECONDS') or 900))
+    user = sa.table('user', sa.column('reserved_image_id', sa.Integer()), sa.column('reservation_expires_at', sa.DateTime()))
+    op.execute(user.update().where(user.c.reserved_image_id != None).values(reservation_expires_at=expires_at))
+
+
+def downgrade():
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_user_reserved_image_id'))
+        batch_op.drop_index(batch_op.f('ix_user_reservation_expires_at'))
+        batch_op.drop_column('reservation_expires_at')
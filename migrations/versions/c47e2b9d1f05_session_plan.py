@@ -0,0 +1,38 @@
+"""session plan
+
+Revision ID: c47e2b9d1f05
+Revises: 9a2c4e6f8b13
+Create Date: 2026-10-18 19:52:08.306415
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c47e2b9d1f05'
+down_revision = '9a2c4e6f8b13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('session_plan',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('step', sa.Integer(), nullable=False),
+    sa.Column('image_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['image_id'], ['image.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('user_id', 'step', name='uq_session_plan_user_id_step')
+    )
+    with op.batch_alter_table('session_plan') as batch_op:
+        batch_op.create_index(batch_op.f('ix_session_plan_image_id'), ['image_id'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('session_plan') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_session_plan_image_id'))
+
+    op.drop_table('session_plan')
@@ -0,0 +1,32 @@
+"""image annotation count
+
+Revision ID: ddd8de33b8ff
+Revises: 8eaeb70cbfa1
+Create Date: 2026-10-18 09:12:40.318207
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'ddd8de33b8ff'
+down_revision = '8eaeb70cbfa1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.add_column(sa.Column('annotation_count', sa.Integer(), server_default='0', nullable=False))
+        batch_op.create_index(batch_op.f('ix_image_annotation_count'), ['annotation_count'], unique=False)
+
+    # Backfill the counts for any annotations collected before this column existed
+    op.execute('UPDATE image SET annotation_count = '
+               '(SELECT COUNT(*) FROM annotation WHERE annotation.image_id = image.id)')
+
+
+def downgrade():
+    with op.batch_alter_table('image') as batch_op:
+        batch_op.drop_index(batch_op.f('ix_image_annotation_count'))
+        batch_op.drop_column('annotation_count')
@@ -1,15 +0,0 @@
-remove_ids = [29821,  267048,  518472,  377476,  522971,  294325,  5313,  141386,  149036,  201940,  308936,  329118,  356868,  357799,  366925,  398099,  431043,  571136,  9771,  20711,  22482,  23253,  28878,  32442,  71441,  83468,  107147,  115251,  125626,  147716,  175047,  179687,  187401,  200796,  204467,  209200,  270716,  275685,  294138,  301207,  302236,  308575,  310606,  339670,  362591,  362683,  363957,  370059,  381547,  390797,  390935,  395178,  399825,  423247,  424124,  441905,  442321,  458914,  459524,  461815,  480026,  481874,  517362,  534866,  546703,  551470,  563617,  571078,  577448,  578023,  579568,  2135,  4684,  5094,  6332,  9895,  12386,  14244,  15906,  16359,  23951,  24980,  26504,  35552,  36098,  36439,  39141,  42725,  43829,  44724,  47548,  47680,  48229,  50658,  53897,  54678,  56023,  58831,  60350,  65195,  67974,  69432,  69874,  80426,  87602,  90490,  99184,  100669,  110084,  114786,  115505,  119379,  122631,  123552,  123949,  126047,  127388,  128838,  130122,  136043,  141785,  142051,  145621,  149842,  150614,  151729,  155058,  155198,  159554,  164262,  168488,  171967,  172151,  179024,  179209,  181631,  188009,  189129,  189915,  192524,  195472,  196108,  200910,  201342,  201929,  203847,  204489,  206467,  208372,  210729,  226176,  227205,  228783,  229827,  236350,  237833,  238200,  239307,  239928,  245590,  248797,  250737,  250749,  250916,  251210,  251502,  252952,  254101,  257773,  258956,  259652,  260696,  262407,  262670,  264309,  269561,  271633,  276870,  281160,  285634,  288486,  293853,  298483,  305600,  314392,  315568,  316474,  322835,  323448,  324261,  325957,  329563,  334616,  338383,  338597,  340220,  340494,  346250,  354220,  363469,  365703,  366313,  369598,  369931,  372604,  375809,  375939,  376731,  379613,  381509,  381789,  385972,  387124,  390756,  399282,  402224,  402762,  403357,  404964,  405057,  406245,  413903,  413923,  414314,  419171,  426776,  427169,  431625,  433296,  435011,  440311,  441108,  441296,  454894,  458864,  460362,  460575,  466890,  467068,  468279,  468518,  484277,  489263,  491831,  493114,  493983,  494208,  494671,  499120,  500005,  508749,  512838,  514131,  514299,  514346,  518966,  520378,  520810,  521416,  521867,  530397,  534633,  538977,  542832,  544261,  547764,  550870,  555101,  556512,  559553,  560885,  563545,  565513,  568640,  571343]
-
-if __name__ == "__main__":
-    import argparse, pathlib, sqlite3
-    
-    parser = argparse.ArgumentParser(description='Load image data into database')
-    parser.add_argument('db', type=pathlib.Path, help='the Sqlite database')
-    db = parser.parse_args().db
-    
-    con = sqlite3.connect(db)
-    cur = con.cursor()
-    [cur.execute(f"DELETE FROM image where id={img_id}") for img_id in remove_ids]
-    con.commit()
-    con.close()
-    
\ No newline at end of file